@@ -4,4 +4,9 @@ from openprocurement.storage.files.storage import FilesStorage
 def includeme(config):
     settings = config.registry.settings
 
-    config.registry.storage = FilesStorage(settings)
+    storage_class = FilesStorage
+    if settings.get('files.backend', 'sync') == 'gevent':
+        from openprocurement.storage.files.cooperative import GeventFilesStorage
+        storage_class = GeventFilesStorage
+    config.registry.storage = storage_class(settings)
+    config.include('openprocurement.storage.files.views')
@@ -0,0 +1,235 @@
+import os
+import sys
+import gzip
+from datetime import timedelta
+from functools import partial
+from threading import Lock, Thread
+from time import time
+from openprocurement.storage.files.compress import copy_blocks, gzip_copy, worth_compress
+from openprocurement.storage.files.replica import WorkerPool
+from openprocurement.storage.files.utils import CounterMixin, get_now, pause
+from openprocurement.documentservice.storage import KeyNotFound
+from openprocurement.documentservice.utils import LOGGER
+
+
+class Throttle(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self.reset()
+
+    def reset(self):
+        self.started = time()
+        self.bytes = 0
+
+    def __call__(self, size):
+        if not self.rate:
+            return
+        self.bytes += size
+        delay = self.started + float(self.bytes) / self.rate - time()
+        if delay > 0:
+            pause(delay)
+
+
+class Archiver(CounterMixin):
+    # move cold files to archive volume which is served from archive_web_root,
+    # compressed files are stored as key.gz for nginx gzip_static always + gunzip
+    def __init__(self, storage, path, after=365, rate=0x1000000, compress=True, min_ratio=0.9,
+                 blocksize=0x100000, restore_on_access=False):
+        self.storage = storage
+        self.path = path
+        self.after = after
+        self.compress = compress
+        self.min_ratio = min_ratio
+        self.blocksize = blocksize
+        self.restore_on_access = restore_on_access
+        self.throttle = Throttle(rate)
+        self.lock = Lock()
+        self.restoring = set()
+        self.restore_pool = WorkerPool(1)
+        self.counters = dict(archived=0, restored=0, failed=0, bytes_read=0, bytes_written=0)
+
+    def copied(self, size):
+        self.count(bytes_read=size)
+        self.throttle(size)
+
+    def transfer(self, src, dst, compress=False, decompress=False, mode=0o440):
+        path = os.path.dirname(dst)
+        if not os.path.exists(path):
+            os.makedirs(path, mode=self.storage.dir_mode)
+        in_file = gzip.open(src, 'rb') if decompress else open(src, 'rb')
+        try:
+            with open(dst + '~', 'wb') as raw_file:
+                if compress:
+                    gzip_copy(in_file, raw_file, 6, self.blocksize, self.copied)
+                else:
+                    copy_blocks(in_file, raw_file, self.blocksize, self.copied)
+                raw_file.flush()
+                os.fsync(raw_file.fileno())
+                self.count(bytes_written=raw_file.tell())
+            os.chmod(dst + '~', mode)
+            os.rename(dst + '~', dst)
+        except Exception:
+            if os.path.exists(dst + '~'):
+                os.unlink(dst + '~')
+            raise
+        finally:
+            in_file.close()
+
+    def worth_compress(self, name):
+        with open(name, 'rb') as in_file:
+            return worth_compress(in_file, self.min_ratio, self.blocksize)
+
+    def archive(self, uuid):
+        storage = self.storage
+        key, meta_name, name, layout = storage.locate(uuid)
+        relative = os.path.join(*layout.data_parts(key))
+        target = os.path.join(self.path, relative)
+        compression = None
+        # hot compressed files are stored as name.gz only and copied as is
+        compressed = not os.path.exists(name)
+        if compressed:
+            source = name + '.gz'
+            size = storage.read_meta(uuid)['size']
+            compression = 'gzip' if self.compress else None
+        else:
+            source = name
+            size = os.path.getsize(name)
+            if self.compress and storage.offload(self.worth_compress, name):
+                compression = 'gzip'
+        if compression:
+            target += '.gz'
+        storage.offload(partial(self.transfer, source, target, compress=bool(compression) and not compressed,
+                                decompress=compressed and not compression, mode=storage.file_mode))
+        # meta is switched first, so file is always available from one of volumes
+        with storage.meta_lock:
+            meta = storage.read_meta(uuid)
+            if meta.get('archived'):  # pragma: no cover
+                os.unlink(target)
+                return False
+            meta['archived'] = True
+            meta.pop('gzip', None)
+            meta['archive'] = dict(path=relative, compression=compression, size=size,
+                                   archived=get_now().isoformat())
+            storage.save_meta(uuid, meta, overwrite=True)
+        for data_name in (name, name + '.gz'):
+            if os.path.exists(data_name):
+                os.unlink(data_name)
+        self.count(archived=1)
+        LOGGER.info("Archived {} to {}".format(uuid, target))
+        return True
+
+    def restore(self, uuid):
+        storage = self.storage
+        meta = storage.read_meta(uuid)
+        if not meta.get('archived'):
+            return False
+        key, meta_name, name, layout = storage.locate(uuid)
+        archive = meta.get('archive') or dict()
+        source = os.path.join(self.path, archive.get('path') or os.path.join(*layout.data_parts(key)))
+        compressed = archive.get('compression') == 'gzip'
+        if compressed:
+            source += '.gz'
+        storage.offload(partial(self.transfer, source, name, decompress=compressed, mode=storage.file_mode))
+        with storage.meta_lock:
+            meta = storage.read_meta(uuid)
+            meta.pop('archived', None)
+            meta.pop('archive', None)
+            storage.save_meta(uuid, meta, overwrite=True)
+        os.unlink(source)
+        storage.schedule_compress(uuid)
+        self.count(restored=1)
+        LOGGER.info("Restored {} from {}".format(uuid, source))
+        return True
+
+    def restore_job(self, uuid):
+        try:
+            self.restore(uuid)
+        except Exception as e:
+            LOGGER.error("Can't restore {}: {}".format(uuid, e))
+            self.count(failed=1)
+        finally:
+            with self.lock:
+                self.restoring.discard(uuid)
+
+    def schedule_restore(self, uuid):
+        with self.lock:
+            if uuid in self.restoring:
+                return
+            self.restoring.add(uuid)
+        self.restore_pool.spawn(self.restore_job, uuid)
+
+    def is_cold(self, meta, name, cutoff, cutoff_iso):
+        if meta.get('archived') or meta.get('modified', meta.get('created', '')) > cutoff_iso:
+            return False
+        try:
+            st = os.stat(name if os.path.exists(name) else name + '.gz')
+        except OSError:
+            return False
+        # atime is updated by nginx reads (at least daily with relatime)
+        return max(st.st_mtime, st.st_atime) < cutoff
+
+    def run(self, limit=0):
+        storage = self.storage
+        cutoff = time() - self.after * 86400
+        cutoff_iso = (get_now() - timedelta(days=self.after)).isoformat()
+        archived = 0
+        self.throttle.reset()
+        for meta, stored in storage.scan_meta():
+            if not stored or 'uuid' not in meta:
+                continue
+            uuid = meta['uuid']
+            if not self.is_cold(meta, storage.locate(uuid)[2], cutoff, cutoff_iso):
+                continue
+            try:
+                archived += self.archive(uuid)
+            except (IOError, OSError, KeyNotFound) as e:
+                LOGGER.error("Can't archive {}: {}".format(uuid, e))
+                self.count(failed=1)
+            if limit and archived >= limit:
+                break
+        return archived
+
+    def loop(self, interval):
+        while True:
+            pause(interval)
+            try:
+                LOGGER.info("Archived {} files".format(self.run()))
+            except Exception as e:  # pragma: no cover
+                LOGGER.error("Archiver error: {}".format(e))
+
+    def start(self, interval):
+        thread = Thread(target=self.loop, args=(interval,), name="archiver")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, restoring=len(self.restoring))
+
+
+def main(argv=sys.argv):
+    from pyramid.paster import get_appsettings, setup_logging
+    from openprocurement.storage.files.storage import FilesStorage
+    args = [s for s in argv[1:] if s != '--restore']
+    if not args:
+        print("usage: {} config.ini [--restore uuid ...]\nArchive cold files to files.archive_path "
+              "or restore selected ones".format(argv[0]))
+        return 1
+    setup_logging(args[0])
+    settings = get_appsettings(args[0])
+    if 'files.archive_path' not in settings:
+        LOGGER.error("files.archive_path is not set")
+        return 1
+    settings['files.background_workers'] = 'false'
+    archiver = FilesStorage(settings).archiver
+    if '--restore' in argv:
+        for uuid in args[1:]:
+            archiver.restore(uuid)
+    else:
+        archiver.run()
+    LOGGER.info("Archiver {}".format(archiver.stats()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    def __init__(self, size=1000):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.counters = dict(hits=0, misses=0, evictions=0)
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.counters['misses'] += 1
+                return default
+            self.data[key] = value
+            self.counters['hits'] += 1
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def pop(self, key):
+        with self.lock:
+            return self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters, size=len(self.data), maxsize=self.size)
+        total = stats['hits'] + stats['misses']
+        stats['ratio'] = round(float(stats['hits']) / total, 4) if total else 0
+        return stats
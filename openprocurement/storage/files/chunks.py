@@ -0,0 +1,313 @@
+import os
+import re
+import errno
+import shutil
+import binascii
+import simplejson as json
+from contextlib import contextmanager
+from fcntl import flock, lockf, LOCK_EX, LOCK_NB, LOCK_UN
+from threading import Lock
+from time import time
+from openprocurement.storage.files.hashing import MultiHash
+from openprocurement.storage.files.ingest import StagedFile, inline
+from openprocurement.storage.files.utils import CounterMixin
+from openprocurement.documentservice.storage import KeyNotFound, StorageUploadError
+from openprocurement.documentservice.utils import LOGGER
+
+
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class ChunkedFile(object):
+    # post_file replacement for FilesStorage.upload_staged
+    def __init__(self, filename, type):
+        self.filename = filename
+        self.type = type
+
+
+def merge_ranges(ranges):
+    merged = list()
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class ChunkedUploads(CounterMixin):
+    # chunks are written in place to sparse data file and may come in any order,
+    # digests are updated in memory while contiguous prefix grows; received
+    # ranges are never overwritten, so hashed prefix always matches the file.
+    # Chunks written by other processes are held by byte range locks of
+    # 'writing' file, ranges log is checked and appended under upload dir lock
+    def __init__(self, path, dir_mode=0o2710, max_size=0x100000000, max_age=86400,
+                 blocksize=0x100000, header_size=2048, new_hash=MultiHash, offload=inline,
+                 new_lock=Lock):
+        self.path = path
+        self.new_hash = new_hash
+        self.offload = offload
+        self.new_lock = new_lock
+        self.dir_mode = dir_mode
+        self.max_size = max_size
+        self.max_age = max_age
+        self.blocksize = blocksize
+        self.header_size = header_size
+        self.lock = Lock()
+        self.digests = dict()
+        self.writing = dict()
+        self.writing_fds = dict()
+        self.last_expire = 0
+        self.counters = dict(started=0, chunks=0, bytes=0, completed=0, expired=0, rehashed=0)
+
+    def upload_path(self, upload_id, name=''):
+        if not UPLOAD_ID.match(upload_id):
+            raise KeyNotFound(upload_id)
+        return os.path.join(self.path, upload_id, name)
+
+    def begin(self, filename, content_type, size=None):
+        if size is not None and not 0 < size <= self.max_size:
+            raise StorageUploadError('file_size_invalid')
+        if time() - self.last_expire > 3600:
+            self.expire()
+        upload_id = binascii.hexlify(os.urandom(16))
+        os.makedirs(self.upload_path(upload_id), mode=self.dir_mode)
+        with open(self.upload_path(upload_id, 'data'), 'wb') as fp:
+            if size:
+                fp.truncate(size)
+        info = dict(filename=filename, content_type=content_type, size=size, created=time())
+        with open(self.upload_path(upload_id, 'info'), 'wt') as fp:
+            json.dump(info, fp)
+        self.count(started=1)
+        return upload_id
+
+    def info(self, upload_id):
+        try:
+            with open(self.upload_path(upload_id, 'info')) as fp:
+                return json.load(fp)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyNotFound(upload_id)
+            raise  # pragma: no cover
+
+    def ranges(self, upload_id):
+        try:
+            with open(self.upload_path(upload_id, 'ranges')) as fp:
+                lines = fp.readlines()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return list()
+            raise  # pragma: no cover
+        return merge_ranges([tuple(map(int, s.split())) for s in lines if s.endswith('\n')])
+
+    @contextmanager
+    def locked(self, upload_id):
+        # held only for checks and appends, never while chunk data is read
+        try:
+            fd = os.open(self.upload_path(upload_id), os.O_RDONLY)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyNotFound(upload_id)
+            raise  # pragma: no cover
+        try:
+            flock(fd, LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def reserve(self, upload_id, span, end):
+        # span of chunk being written grows up to end, it must not overlap
+        # received ranges or other chunks written concurrently
+        with self.lock:
+            writing = self.writing.setdefault(upload_id, list())
+            others = [tuple(other) for other in writing if other is not span]
+            with self.locked(upload_id):
+                for start, stop in self.ranges(upload_id) + others:
+                    if span[0] < stop and start < end:
+                        raise StorageUploadError('chunk_overlaps')
+                fd = self.writing_fds.get(upload_id)
+                if fd is None:
+                    fd = self.writing_fds[upload_id] = os.open(self.upload_path(upload_id, 'writing'),
+                                                               os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    # posix locks don't conflict within process, spans above cover threads
+                    if end > span[1]:
+                        lockf(fd, LOCK_EX | LOCK_NB, end - span[1], span[1])
+                except IOError as e:
+                    if e.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise  # pragma: no cover
+                    raise StorageUploadError('chunk_overlaps')
+            span[1] = end
+            if not any(other is span for other in writing):
+                writing.append(span)
+
+    def unreserve(self, upload_id, span):
+        with self.lock:
+            writing = self.writing.get(upload_id, [])
+            if span[1] > span[0] and any(other is span for other in writing):
+                lockf(self.writing_fds[upload_id], LOCK_UN, span[1] - span[0], span[0])
+            writing = [other for other in writing if other is not span]
+            if writing:
+                self.writing[upload_id] = writing
+            else:
+                self.writing.pop(upload_id, None)
+                fd = self.writing_fds.pop(upload_id, None)
+                if fd is not None:
+                    os.close(fd)
+
+    def write(self, upload_id, offset, in_file, length=None, total=None):
+        info = self.info(upload_id)
+        if total is not None and info['size'] and total != info['size']:
+            raise StorageUploadError('file_size_mismatch')
+        limit = info['size'] or self.max_size
+        if offset < 0 or offset >= limit or (length is not None and offset + length > limit):
+            raise StorageUploadError('chunk_out_of_range')
+        span = [offset, offset]
+        try:
+            if length is not None:
+                # known length is checked before body is read
+                self.reserve(upload_id, span, min(limit, offset + length))
+            written = self.write_data(upload_id, span, in_file, length, limit)
+        finally:
+            self.unreserve(upload_id, span)
+        self.count(chunks=1, bytes=written)
+        ranges = self.ranges(upload_id)
+        self.advance(upload_id, ranges)
+        return ranges
+
+    def write_data(self, upload_id, span, in_file, length, limit):
+        offset = span[0]
+        written = 0
+        with open(self.upload_path(upload_id, 'data'), 'r+b') as fp:
+            fp.seek(offset)
+            while length is None or written < length:
+                block = in_file.read(self.blocksize if length is None else min(self.blocksize, length - written))
+                if not block:
+                    break
+                if offset + written + len(block) > limit:
+                    raise StorageUploadError('chunk_out_of_range')
+                if offset + written + len(block) > span[1]:
+                    self.reserve(upload_id, span, offset + written + len(block))
+                # body is read by caller, only disk writes are offloaded
+                self.offload(fp.write, block)
+                written += len(block)
+            # range is recorded only after data is on disk, so it survives restarts
+            self.offload(self.sync_data, fp)
+        if written:
+            self.offload(self.record_range, upload_id, offset, offset + written)
+        return written
+
+    def sync_data(self, fp):
+        fp.flush()
+        os.fdatasync(fp.fileno())
+
+    def record_range(self, upload_id, start, end):
+        # appended before byte range lock is released, so reserve sees either of them
+        with self.locked(upload_id):
+            fd = os.open(self.upload_path(upload_id, 'ranges'), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, "{} {}\n".format(start, end))
+            finally:
+                os.close(fd)
+
+    def advance(self, upload_id, ranges, wait=False):
+        with self.lock:
+            state = self.digests.get(upload_id)
+            if state is None:
+                state = self.digests[upload_id] = dict(hash=self.new_hash(), offset=0, lock=self.new_lock())
+        if not state['lock'].acquire(wait):
+            return state
+        try:
+            end = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+            if end > state['offset']:
+                self.offload(self.read_hash, upload_id, state, end)
+        finally:
+            state['lock'].release()
+        return state
+
+    def read_hash(self, upload_id, state, end):
+        with open(self.upload_path(upload_id, 'data'), 'rb') as fp:
+            fp.seek(state['offset'])
+            while state['offset'] < end:
+                block = fp.read(min(self.blocksize, end - state['offset']))
+                if not block:  # pragma: no cover
+                    break
+                state['hash'].update(block)
+                state['offset'] += len(block)
+
+    def is_complete(self, info, ranges):
+        size = info['size'] or (ranges[-1][1] if ranges else 0)
+        return size and ranges == [(0, size)]
+
+    def complete(self, upload_id):
+        info = self.info(upload_id)
+        ranges = self.ranges(upload_id)
+        if not self.is_complete(info, ranges):
+            raise StorageUploadError('upload_incomplete')
+        size = ranges[0][1]
+        with self.lock:
+            if upload_id not in self.digests:
+                # chunks were received by other process
+                self.counters['rehashed'] += 1
+        name = self.upload_path(upload_id, 'data')
+        try:
+            fp = open(name, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                # published by concurrent complete
+                raise KeyNotFound(upload_id)
+            raise  # pragma: no cover
+        try:
+            # held until data is published or upload is removed
+            flock(fp, LOCK_EX | LOCK_NB)
+        except IOError:
+            fp.close()
+            raise StorageUploadError('upload_completing')
+        try:
+            state = self.advance(upload_id, ranges, wait=True)
+        except Exception:
+            fp.close()
+            raise
+        staged = StagedFile(fp, name)
+        staged.size = size
+        staged.digests, staged.chunks = state['hash'].close()
+        staged.md5hash = "md5:" + staged.digests['md5']
+        staged.header = staged.fp.read(self.header_size)
+        staged.fp.seek(0)
+        self.count(completed=1)
+        return ChunkedFile(info['filename'], info['content_type']), staged
+
+    def status(self, upload_id):
+        info = self.info(upload_id)
+        ranges = self.ranges(upload_id)
+        received = sum([end - start for start, end in ranges])
+        return dict(info, ranges=ranges, received=received, complete=bool(self.is_complete(info, ranges)))
+
+    def remove(self, upload_id):
+        with self.lock:
+            self.digests.pop(upload_id, None)
+        shutil.rmtree(self.upload_path(upload_id), ignore_errors=True)
+
+    def expire(self):
+        self.last_expire = time()
+        # uploads completed or expired by other processes
+        with self.lock:
+            upload_ids = list(self.digests)
+        for upload_id in upload_ids:
+            if not os.path.exists(self.upload_path(upload_id)):
+                with self.lock:
+                    self.digests.pop(upload_id, None)
+        if not os.path.exists(self.path):
+            return
+        for upload_id in os.listdir(self.path):
+            try:
+                if time() - os.path.getmtime(self.upload_path(upload_id, 'data')) > self.max_age:
+                    LOGGER.info("Remove expired chunked upload {}".format(upload_id))
+                    self.remove(upload_id)
+                    self.count(expired=1)
+            except (KeyNotFound, OSError):
+                continue
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, active=len(self.digests))
@@ -0,0 +1,78 @@
+import os
+import gzip
+import zlib
+
+
+def worth_compress(in_file, min_ratio=0.9, blocksize=0x100000):
+    # probe first block with fast level, skip already compressed formats
+    block = in_file.read(blocksize)
+    in_file.seek(0)
+    return bool(block) and len(zlib.compress(block, 1)) < min_ratio * len(block)
+
+
+def copy_blocks(in_file, out_file, blocksize=0x100000, callback=None):
+    while True:
+        block = in_file.read(blocksize)
+        if not block:
+            break
+        out_file.write(block)
+        if callback:
+            callback(len(block))
+
+
+def gzip_copy(in_file, raw_file, level=6, blocksize=0x100000, callback=None):
+    # mtime=0 keeps output same for same content
+    out_file = gzip.GzipFile('', 'wb', level, raw_file, mtime=0)
+    copy_blocks(in_file, out_file, blocksize, callback)
+    out_file.close()
+
+
+def write_sibling(name, level=6, min_ratio=0.9, mode=0o440):
+    # write name.gz next to stored file, return its size or None if not worth it,
+    # caller removes original once meta is switched
+    with open(name, 'rb') as in_file:
+        if not worth_compress(in_file, min_ratio):
+            return
+        size = os.fstat(in_file.fileno()).st_size
+        with open(name + '.gz~', 'wb') as raw_file:
+            gzip_copy(in_file, raw_file, level)
+            gz_size = raw_file.tell()
+    if gz_size >= min_ratio * size:
+        os.unlink(name + '.gz~')
+        return
+    os.chmod(name + '.gz~', mode)
+    os.rename(name + '.gz~', name + '.gz')
+    return gz_size
+
+
+def data_exists(name):
+    # compressed data is kept as name.gz only
+    return os.path.exists(name) or os.path.exists(name + '.gz')
+
+
+class SizedFile(object):
+    # gzip files can't seek from end, so size of content is given
+    def __init__(self, in_file, size=None):
+        self.in_file = in_file
+        self.size = size
+        self.at_end = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.at_end = whence == os.SEEK_END and self.size is not None
+        if not self.at_end:
+            return self.in_file.seek(offset, whence)
+
+    def tell(self):
+        return self.size if self.at_end else self.in_file.tell()
+
+    def read(self, size=-1):
+        return self.in_file.read(size)
+
+    def close(self):
+        self.in_file.close()
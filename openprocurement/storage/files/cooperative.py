@@ -0,0 +1,120 @@
+import sys
+from threading import Lock
+from openprocurement.storage.files.replica import ReplicaPools
+from openprocurement.storage.files.storage import FilesStorage
+from openprocurement.documentservice.utils import LOGGER
+
+try:
+    from gevent import sleep
+    from gevent.monkey import get_original, is_module_patched
+    from gevent.pool import Pool
+    from gevent.threadpool import ThreadPool
+except ImportError:  # pragma: no cover
+    ThreadPool = None
+
+
+def call(func, args):
+    # expected errors like KeyNotFound are re-raised in greenlet, not reported by threadpool
+    try:
+        return True, func(*args)
+    except Exception:
+        return False, sys.exc_info()
+
+
+class GreenletPool(object):
+    # WorkerPool interface on greenlets
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.pool = Pool(self.size)
+
+    def run(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:  # pragma: no cover
+            LOGGER.error("Worker {} error: {}".format(func.__name__, e))
+
+    def spawn(self, func, *args):
+        self.pool.spawn(self.run, func, args)
+
+    def join(self):
+        self.pool.join()
+
+
+class CooperativeLock(object):
+    # native lock for sections which offload while holding it: greenlets poll it,
+    # so waiting doesn't block the loop which has to resume the holder
+    def __init__(self, hub_thread, poll=0.001):
+        self.lock = get_original('thread', 'allocate_lock')()
+        self.hub_thread = hub_thread
+        self.poll = poll
+
+    def acquire(self, blocking=True):
+        if get_original('thread', 'get_ident')() != self.hub_thread:
+            return self.lock.acquire(blocking)
+        while not self.lock.acquire(False):
+            if not blocking:
+                return False
+            sleep(self.poll)
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class GeventFilesStorage(FilesStorage):
+    # disk and cpu bound work (staging with hashing, meta files and sqlite, hash index,
+    # archive scan, publish, journal fsync, chunk writes and re-hashing, gzip copies,
+    # scrub digests, archive transfers, sync tree builds and layout migration) runs in
+    # bounded pool of native threads, replica uploads, compress jobs and background loops
+    # run in greenlets over monkey patched sockets; offloaded code must not wait for
+    # greenlets, so it only takes native locks, locks held across offload are cooperative
+    def __init__(self, settings):
+        if ThreadPool is None:  # pragma: no cover
+            raise ValueError("files.backend = gevent requires gevent")
+        # background loops may offload before FilesStorage.__init__ returns
+        self.threadpool = ThreadPool(int(settings.get('files.offload_threads', 10)))
+        self.offload_lock = Lock()
+        self.offloaded = dict(calls=0, inflight=0)
+        self.hub_thread = get_original('thread', 'get_ident')()
+        FilesStorage.__init__(self, settings)
+        self.ingest.lock = get_original('thread', 'allocate_lock')()
+        # counters and throttles of offloaded background work
+        self.scrubber.lock = get_original('thread', 'allocate_lock')()
+        self.scrubber.throttle_lock = get_original('thread', 'allocate_lock')()
+        if self.archiver:
+            self.archiver.lock = get_original('thread', 'allocate_lock')()
+        # staging already runs in threadpool, digest threads would only add switches
+        self.ingest.parallel_min = None
+        if is_module_patched('socket'):
+            self.replica_pool = ReplicaPools(self.replica_names, self.replica_pool.size, new_pool=GreenletPool)
+            self.compress_pool = GreenletPool(self.compress_pool.size)
+        else:
+            LOGGER.warning("Gevent storage backend without monkey patching, only hashing is offloaded")
+
+    def new_lock(self):
+        return CooperativeLock(self.hub_thread)
+
+    def offload(self, func, *args):
+        with self.offload_lock:
+            self.offloaded['calls'] += 1
+            self.offloaded['inflight'] += 1
+        try:
+            ok, result = self.threadpool.apply(call, (func, args))
+        finally:
+            with self.offload_lock:
+                self.offloaded['inflight'] -= 1
+        if not ok:
+            raise result[0], result[1], result[2]
+        return result
+
+    def get_stats(self):
+        stats = FilesStorage.get_stats(self)
+        with self.offload_lock:
+            stats['offload'] = dict(self.offloaded, threads=self.threadpool.maxsize)
+        return stats
@@ -0,0 +1,128 @@
+import hashlib
+from Queue import Queue
+from threading import Thread
+
+
+class DigestWorker(object):
+    # serial digest fed through bounded queue, hashlib releases GIL on large blocks
+    def __init__(self, digest, queue_size=8):
+        self.digest = digest
+        self.queue = Queue(queue_size)
+        self.error = None
+        self.thread = Thread(target=self.run, name="digest-{}".format(digest.name.lower()))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                break
+            if isinstance(block, Queue):
+                # copy request, all blocks before it are hashed
+                block.put(self.digest.copy())
+                continue
+            try:
+                self.digest.update(block)
+            except Exception as e:  # pragma: no cover
+                self.error = e
+
+    def update(self, block):
+        self.queue.put(block)
+
+    def copy(self):
+        result = Queue(1)
+        self.queue.put(result)
+        return result.get()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:  # pragma: no cover
+            raise self.error
+
+
+class ChunkDigests(object):
+    # running digest of fixed size chunks, nothing of chunk itself is buffered
+    name = 'chunks'
+
+    def __init__(self, chunk_size, algorithm='sha256'):
+        self.chunk_size = chunk_size
+        self.algorithm = algorithm
+        self.digest = hashlib.new(algorithm)
+        self.length = 0
+        self.digests = list()
+
+    def update(self, block):
+        while block:
+            size = self.chunk_size - self.length
+            part, block = (block, '') if len(block) <= size else (buffer(block, 0, size), buffer(block, size))
+            self.digest.update(part)
+            self.length += len(part)
+            if self.length == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        self.digests.append(self.digest.hexdigest())
+        self.digest = hashlib.new(self.algorithm)
+        self.length = 0
+
+    def hexdigests(self):
+        # single chunk is not listed
+        if self.length:
+            self.flush()
+        return self.digests if len(self.digests) > 1 else []
+
+
+class MultiHash(object):
+    # md5 and extra digests in single pass plus digests of fixed size chunks;
+    # chunks are hashed only after input grows over first chunk, which is the
+    # copy of whole file digest of same algorithm at that point; once input
+    # grows over parallel_min every digest gets own thread with bounded queue,
+    # so large files use several cores in constant memory
+    def __init__(self, algorithms=('md5',), chunk_size=0, chunk_algorithm='sha256', parallel_min=None):
+        # digest.name is upper case in python 2
+        self.names = list(algorithms)
+        self.digests = [hashlib.new(name) for name in algorithms]
+        self.workers = None
+        self.parallel_min = parallel_min
+        self.size = 0
+        self.chunk_size = chunk_size
+        self.chunk_algorithm = chunk_algorithm
+        self.chunks = None
+        if chunk_size and chunk_algorithm not in self.names:
+            self.start_chunks()
+
+    def start_chunks(self, first=None):
+        self.chunks = ChunkDigests(self.chunk_size, self.chunk_algorithm)
+        if first:
+            self.chunks.digests.append(first)
+        self.digests.append(self.chunks)
+        if self.workers:
+            self.workers.append(DigestWorker(self.chunks))
+
+    def update(self, block):
+        if self.chunk_size and self.chunks is None and self.size + len(block) > self.chunk_size:
+            head = self.chunk_size - self.size
+            self.feed(buffer(block, 0, head))
+            index = self.names.index(self.chunk_algorithm)
+            digest = self.workers[index].copy() if self.workers else self.digests[index].copy()
+            self.start_chunks(digest.hexdigest())
+            block = buffer(block, head)
+        self.feed(block)
+
+    def feed(self, block):
+        self.size += len(block)
+        if self.workers is None and self.parallel_min is not None and self.size > self.parallel_min:
+            self.workers = [DigestWorker(digest) for digest in self.digests]
+        for digest in self.workers or self.digests:
+            digest.update(block)
+
+    def close(self):
+        # returns ({algorithm: hexdigest}, chunk digests)
+        if self.workers:
+            for worker in self.workers:
+                worker.close()
+            self.workers = None
+        return (dict((name, d.hexdigest()) for name, d in zip(self.names, self.digests)),
+                self.chunks.hexdigests() if self.chunks else [])
@@ -0,0 +1,190 @@
+import os
+import sys
+import sqlite3
+import simplejson as json
+from threading import Lock
+from openprocurement.storage.files.compress import data_exists
+from openprocurement.storage.files.layout import Layout, read_marker
+from openprocurement.storage.files.ingest import inline
+from openprocurement.documentservice.utils import LOGGER
+
+
+class HashIndex(object):
+    def __init__(self, filename, mmap_size=0x10000000, timeout=30, batch_size=1000, offload=inline, new_lock=Lock):
+        self.filename = filename
+        self.offload = offload
+        self.mmap_size = mmap_size
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.db = None
+        # index holds every stored hash, so miss needs no disk check
+        self.complete = False
+        # write failed, index may be behind the store until rebuilt
+        self.stale = False
+        self.lock = new_lock()
+        self.counters = dict(lookups=0, found=0, stored=0, updates=0, errors=0)
+
+    def connect(self):
+        path = os.path.dirname(self.filename)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        db = sqlite3.connect(self.filename, timeout=self.timeout, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA mmap_size={:d}".format(self.mmap_size))
+        db.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                   "hash TEXT PRIMARY KEY, uuid TEXT NOT NULL, stored INTEGER NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS info (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        db.commit()
+        return db
+
+    def execute(self, query, args=(), commit=False):
+        with self.lock:
+            return self.offload(self.run, query, args, commit)
+
+    def run(self, query, args, commit):
+        # called with lock held
+        if self.db is None:
+            self.db = self.connect()
+        try:
+            rows = self.db.execute(query, args).fetchall()
+            if commit:
+                self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        return rows
+
+    def safe_execute(self, query, args=(), commit=False):
+        # index is an optimization, on errors callers check the disk instead
+        try:
+            return self.execute(query, args, commit)
+        except sqlite3.Error as e:
+            LOGGER.warning("Hash index error, fall back to disk checks: {}".format(e))
+            with self.lock:
+                self.counters['errors'] += 1
+                self.stale = True
+                self.complete = False
+
+    def get(self, md5hash):
+        rows = self.safe_execute("SELECT uuid, stored FROM hashes WHERE hash=?", (md5hash,))
+        with self.lock:
+            self.counters['lookups'] += 1
+            if rows:
+                self.counters['found'] += 1
+                self.counters['stored'] += rows[0][1]
+        return rows[0] if rows else None
+
+    def add(self, md5hash, uuid):
+        self.safe_execute("INSERT OR IGNORE INTO hashes VALUES (?, ?, 0)", (md5hash, uuid), commit=True)
+
+    def set(self, md5hash, uuid, stored):
+        self.safe_execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)", (md5hash, uuid, int(stored)),
+                          commit=True)
+        with self.lock:
+            self.counters['updates'] += 1
+
+    def is_complete(self):
+        # may be rebuilt by other process, so only positive answer is cached
+        if not self.complete and not self.stale:
+            self.complete = bool(self.safe_execute("SELECT value FROM info WHERE name='complete'"))
+        return self.complete
+
+    def set_complete(self):
+        self.execute("INSERT OR REPLACE INTO info VALUES ('complete', '1')", commit=True)
+        self.complete = True
+
+    def run_script(self, script):
+        if self.db is None:
+            self.db = self.connect()
+        self.db.executescript(script)
+
+    def rebuild(self, save_path, metas=None):
+        # fill new table in short transactions while service keeps using the old one,
+        # writes made meanwhile are copied by trigger and win over scanned state
+        with self.lock:
+            self.offload(self.run_script, REBUILD_BEGIN)
+        count = 0
+        rows = list()
+        for meta, stored in metas or scan_meta(save_path):
+            rows.append((meta['hash'], meta['uuid'], int(stored)))
+            if len(rows) >= self.batch_size:
+                count += self.insert_rebuilt(rows)
+                rows = list()
+        count += self.insert_rebuilt(rows)
+        with self.lock:
+            self.offload(self.run_script, REBUILD_SWAP)
+            self.complete = True
+            self.stale = False
+        return count
+
+    def insert_rebuilt(self, rows):
+        with self.lock:
+            self.offload(self.insert_many, "INSERT OR IGNORE INTO hashes_rebuild VALUES (?, ?, ?)", rows)
+        return len(rows)
+
+    def insert_many(self, query, rows):
+        self.db.executemany(query, rows)
+        self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+REBUILD_BEGIN = """
+BEGIN IMMEDIATE;
+DROP TRIGGER IF EXISTS hashes_rebuild_copy;
+DROP TABLE IF EXISTS hashes_rebuild;
+CREATE TABLE hashes_rebuild (hash TEXT PRIMARY KEY, uuid TEXT NOT NULL, stored INTEGER NOT NULL);
+CREATE TRIGGER hashes_rebuild_copy AFTER INSERT ON hashes BEGIN
+    INSERT OR REPLACE INTO hashes_rebuild VALUES (NEW.hash, NEW.uuid, NEW.stored);
+END;
+COMMIT;
+"""
+
+REBUILD_SWAP = """
+BEGIN IMMEDIATE;
+DROP TABLE hashes;
+ALTER TABLE hashes_rebuild RENAME TO hashes;
+INSERT OR REPLACE INTO info VALUES ('complete', '1');
+COMMIT;
+"""
+
+
+def scan_meta(save_path):
+    # walk shards of current and not yet migrated layout, yield (meta, stored),
+    # archived documents count as stored
+    layout, previous = read_marker(save_path)
+    for layout in filter(None, [layout or Layout(save_path), previous]):
+        for dirs, key in layout.walk():
+            meta_name, data_name = layout.paths(key, dirs)
+            try:
+                with open(meta_name) as fp:
+                    meta = json.load(fp)
+            except (IOError, ValueError) as e:
+                LOGGER.error("Can't read {}: {}".format(meta_name, e))
+                continue
+            yield meta, bool(meta.get('archived')) or data_exists(data_name)
+
+
+def main(argv=sys.argv):
+    from pyramid.paster import get_appsettings, setup_logging
+    if len(argv) != 2:
+        print("usage: {} config.ini\nRebuild files.hash_index by scan of files.save_path".format(argv[0]))
+        return 1
+    setup_logging(argv[1])
+    settings = get_appsettings(argv[1])
+    save_path = settings['files.save_path'].strip()
+    index = HashIndex(os.path.join(save_path, 'hashes.db'))
+    metas = None
+    if settings.get('files.meta_backend', 'file') != 'file':
+        from openprocurement.storage.files.storage import FilesStorage
+        settings['files.background_workers'] = 'false'
+        metas = FilesStorage(settings).scan_meta()
+    count = index.rebuild(save_path, metas)
+    LOGGER.info("Hash index rebuilt with {} hashes".format(count))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+import os
+import errno
+import ctypes
+from fcntl import flock, LOCK_EX, LOCK_NB
+from shutil import copyfileobj
+from tempfile import mkstemp
+from threading import Lock
+from openprocurement.storage.files.hashing import MultiHash
+from openprocurement.storage.files.utils import CounterMixin, load_libc
+
+
+def libc_sendfile():
+    try:
+        func = load_libc().sendfile64
+    except AttributeError:  # pragma: no cover
+        return
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        res = func(out_fd, in_fd, ctypes.byref(offset), count)
+        if res < 0:  # pragma: no cover
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return res
+
+    return sendfile
+
+
+# python 2 has no os.sendfile
+sendfile = getattr(os, 'sendfile', None) or libc_sendfile()
+
+
+def file_fd(in_file):
+    # returns fd of uploads spooled to disk or None
+    try:
+        fd = in_file.fileno()
+        os.fstat(fd)
+    except (AttributeError, IOError, OSError, ValueError):
+        return
+    return fd
+
+
+def inline(func, *args):
+    # default offload, cooperative backend runs func in native thread
+    return func(*args)
+
+
+class StagedFile(object):
+    def __init__(self, fp, name):
+        self.fp = fp
+        self.name = name
+        self.md5hash = None
+        self.digests = dict()
+        self.chunks = list()
+        self.header = ''
+        self.size = 0
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.close()
+
+    def publish(self, name, mode):
+        # file is closed after it is moved, lock taken on it covers publishing
+        try:
+            os.chmod(self.name, mode)
+            try:
+                os.rename(self.name, name)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # shard directory is mounted from other volume
+                with open(self.name, 'rb') as in_file, open(name + '~', 'wb') as out_file:
+                    flock(out_file, LOCK_EX | LOCK_NB)
+                    copyfileobj(in_file, out_file, 0x100000)
+                os.rename(name + '~', name)
+                os.chmod(name, mode)
+                os.unlink(self.name)
+        finally:
+            self.close()
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.name):
+            os.unlink(self.name)
+
+
+class StreamIngest(CounterMixin):
+    def __init__(self, path, blocksize=0x100000, header_size=2048, dir_mode=0o2710, zero_copy=True,
+                 algorithms=('md5', 'sha256'), chunk_size=0x800000, parallel_min=0x800000):
+        self.path = path
+        self.blocksize = blocksize
+        self.header_size = header_size
+        self.dir_mode = dir_mode
+        self.zero_copy = zero_copy
+        self.algorithms = ('md5',) + tuple([s for s in algorithms if s != 'md5'])
+        self.chunk_size = chunk_size
+        # None keeps hashing in calling thread
+        self.parallel_min = parallel_min
+        self.lock = Lock()
+        self.counters = dict(files=0, bytes_read=0, bytes_written=0, bytes_sent=0, parallel=0)
+
+    def new_hash(self, parallel=False):
+        if parallel and self.parallel_min is not None:
+            return MultiHash(self.algorithms, self.chunk_size, parallel_min=self.parallel_min)
+        return MultiHash(self.algorithms, self.chunk_size)
+
+    def stage(self, in_file):
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path, mode=self.dir_mode)
+            except OSError as e:  # pragma: no cover
+                # created by concurrent upload
+                if e.errno != errno.EEXIST:
+                    raise
+        fd, name = mkstemp(suffix='~', dir=self.path)
+        staged = StagedFile(os.fdopen(fd, 'w+b'), name)
+        try:
+            if self.zero_copy and sendfile and file_fd(in_file) is not None:
+                self.copy_kernel(in_file, staged)
+            else:
+                self.copy(in_file, staged)
+        except Exception:
+            staged.remove()
+            raise
+        return staged
+
+    def digest(self, in_file, staged, write=None):
+        in_file.seek(0)
+        hasher = self.new_hash(parallel=True)
+        header = list()
+        header_size = 0
+        try:
+            while True:
+                block = in_file.read(self.blocksize)
+                if not block:
+                    break
+                hasher.update(block)
+                if header_size < self.header_size:
+                    header.append(block[:self.header_size - header_size])
+                    header_size += len(header[-1])
+                if write:
+                    write(block, staged.size)
+                staged.size += len(block)
+        finally:
+            parallel = bool(hasher.workers)
+            staged.digests, staged.chunks = hasher.close()
+        staged.fp.flush()
+        staged.fp.seek(0)
+        staged.md5hash = "md5:" + staged.digests['md5']
+        staged.header = ''.join(header)
+        self.count(files=1, bytes_read=staged.size, parallel=int(parallel))
+
+    def copy(self, in_file, staged):
+        self.digest(in_file, staged, lambda block, offset: staged.fp.write(block))
+        self.count(bytes_written=staged.size)
+
+    def copy_kernel(self, in_file, staged):
+        in_fd = in_file.fileno()
+        out_fd = staged.fp.fileno()
+
+        def write(block, offset):
+            count = len(block)
+            while count > 0:
+                sent = sendfile(out_fd, in_fd, offset, count)
+                if sent <= 0:  # pragma: no cover
+                    raise IOError("sendfile returned {}".format(sent))
+                offset += sent
+                count -= sent
+
+        self.digest(in_file, staged, write)
+        self.count(bytes_sent=staged.size)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
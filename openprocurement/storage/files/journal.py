@@ -0,0 +1,112 @@
+import os
+import hashlib
+import simplejson as json
+from fcntl import flock, LOCK_EX, LOCK_NB
+from threading import Event, Lock
+from time import time
+from openprocurement.storage.files.ingest import inline
+
+
+class ReplicationJournal(object):
+    def __init__(self, path, retry_delay=10, max_delay=600, dir_mode=0o2710, offload=inline):
+        self.path = path
+        self.offload = offload
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.event = Event()
+        self.lock = Lock()
+        self.inflight = dict()
+        self.counters = dict(appended=0, completed=0, dropped=0, retries=0)
+        if not os.path.exists(path):
+            os.makedirs(path, mode=dir_mode)
+
+    def sync_dir(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def write_job(self, name, job):
+        filename = os.path.join(self.path, name)
+        with open(filename + '~', 'wt') as fp:
+            json.dump(job, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(filename + '~', filename)
+        self.sync_dir()
+
+    def replica_tag(self, replica):
+        return hashlib.sha1(replica).hexdigest()[:8]
+
+    def job_tag(self, name):
+        return name[:-len('.job')].rsplit('-', 1)[-1]
+
+    def append(self, uuid, replica, **job):
+        created = time()
+        name = "{:017.6f}-{}-{}.job".format(created, uuid, self.replica_tag(replica))
+        job.update(uuid=uuid, replica=replica, created=created, attempts=0, next_try=created)
+        self.offload(self.write_job, name, job)
+        with self.lock:
+            self.counters['appended'] += 1
+        self.event.set()
+        return name
+
+    def pending(self):
+        return sorted([s for s in os.listdir(self.path) if s.endswith('.job')])
+
+    def claim(self, name):
+        with self.lock:
+            if name in self.inflight:
+                return
+            self.inflight[name] = None
+        try:
+            fp = open(os.path.join(self.path, name))
+        except (IOError, OSError):
+            return self.release(name)
+        try:
+            flock(fp, LOCK_EX | LOCK_NB)
+            # job was completed or rewritten by other process
+            if os.fstat(fp.fileno()).st_nlink == 0:
+                raise IOError("Job {} gone".format(name))
+            job = json.load(fp)
+        except (IOError, ValueError):
+            fp.close()
+            return self.release(name)
+        if job.get('next_try', 0) > time():
+            fp.close()
+            return self.release(name)
+        with self.lock:
+            self.inflight[name] = fp
+        return job
+
+    def release(self, name):
+        with self.lock:
+            fp = self.inflight.pop(name, None)
+        if fp:
+            fp.close()
+
+    def complete(self, name, dropped=False):
+        os.unlink(os.path.join(self.path, name))
+        self.release(name)
+        with self.lock:
+            self.counters['dropped' if dropped else 'completed'] += 1
+
+    def retry(self, name, job, error):
+        job['attempts'] += 1
+        job['error'] = str(error)
+        job['next_try'] = time() + min(self.max_delay, self.retry_delay * 2 ** min(job['attempts'], 16))
+        self.offload(self.write_job, name, job)
+        self.release(name)
+        with self.lock:
+            self.counters['retries'] += 1
+
+    def stats(self):
+        pending = self.pending()
+        lag = 0
+        if pending:
+            lag = max(0, time() - float(pending[0].split('-', 1)[0]))
+        with self.lock:
+            stats = dict(self.counters, inflight=len(self.inflight))
+        stats.update(pending=len(pending), lag=round(lag, 3))
+        return stats
@@ -0,0 +1,239 @@
+import os
+import errno
+import simplejson as json
+from fcntl import flock, LOCK_EX, LOCK_NB
+from time import time
+from openprocurement.documentservice.utils import LOGGER
+
+
+MARKER = 'layout.json'
+
+
+class Layout(object):
+    # version 1 is legacy key[-2:]/key[-4:]/key with meta next to data,
+    # version 2 splits key prefix into depth levels of width hex chars each
+    # (fan-out 16 ** width) and keeps meta and data in separate trees
+    def __init__(self, root, version=1, depth=2, width=2):
+        self.root = root
+        self.version = version
+        self.depth = depth
+        self.width = width
+        if version == 1:
+            self.meta_root = self.data_root = root
+            self.data_prefix = ()
+            self.levels = (2, 4)
+        elif version == 2:
+            if depth < 1 or width < 1 or depth * width > 16:
+                raise ValueError("Bad layout depth {} width {}".format(depth, width))
+            self.meta_root = os.path.join(root, 'meta')
+            self.data_root = os.path.join(root, 'data')
+            self.data_prefix = ('data',)
+            self.levels = (width,) * depth
+        else:
+            raise ValueError("Unknown layout version {}".format(version))
+
+    def __repr__(self):
+        return "<Layout v{version} depth={depth} width={width}>".format(**self.to_dict())
+
+    def __eq__(self, other):
+        return isinstance(other, Layout) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    @classmethod
+    def from_settings(cls, root, settings):
+        version = int(settings.get('files.layout_version', 1))
+        if version == 1:
+            return cls(root)
+        return cls(root, version,
+                   depth=int(settings.get('files.layout_depth', 2)),
+                   width=int(settings.get('files.layout_width', 2)))
+
+    @classmethod
+    def from_dict(cls, root, data):
+        if data['version'] == 1:
+            return cls(root)
+        return cls(root, data['version'], depth=data['depth'], width=data['width'])
+
+    def to_dict(self):
+        if self.version == 1:
+            return dict(version=1, depth=2, width=2)
+        return dict(version=self.version, depth=self.depth, width=self.width)
+
+    def dirs(self, key):
+        if self.version == 1:
+            return key[-2:], key[-4:]
+        width = self.width
+        return tuple([key[n * width:(n + 1) * width] for n in range(self.depth)])
+
+    def data_parts(self, key):
+        return self.data_prefix + self.dirs(key) + (key,)
+
+    def paths(self, key, dirs=None):
+        dirs = dirs or self.dirs(key)
+        return (os.path.join(self.meta_root, *dirs) + '/' + key + '.meta',
+                os.path.join(self.data_root, *dirs) + '/' + key)
+
+    def walk(self, data=False, path=None, dirs=()):
+        # yield (shard dirs, key) of all meta (or data) files in shard order
+        path = path or (self.data_root if data else self.meta_root)
+        level = len(dirs)
+        try:
+            names = sorted(os.listdir(path))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise  # pragma: no cover
+        if level == len(self.levels):
+            if data:
+                # compressed data is stored as key.gz only
+                names = [s.rstrip('~') for s in names]
+                names = [s[:-3] if s.endswith('.gz') else s for s in names]
+                keys = sorted(set([s for s in names if '.' not in s]))
+            else:
+                keys = [s[:-len('.meta')] for s in names if s.endswith('.meta')]
+            for key in keys:
+                yield dirs, key
+            return
+        for name in names:
+            if len(name) == self.levels[level] and os.path.isdir(os.path.join(path, name)):
+                for item in self.walk(data, os.path.join(path, name), dirs + (name,)):
+                    yield item
+
+    def prune(self, path=None, level=0):
+        # remove empty shard directories left after migration
+        try:
+            names = os.listdir(path or self.meta_root)
+        except OSError:
+            return
+        for name in names:
+            subpath = os.path.join(path or self.meta_root, name)
+            if len(name) != self.levels[level] or not os.path.isdir(subpath):
+                continue
+            if level + 1 < len(self.levels):
+                self.prune(subpath, level + 1)
+            try:
+                os.rmdir(subpath)
+            except OSError:
+                pass
+        if path is None and self.data_root != self.meta_root:
+            self.prune(self.data_root, level)
+
+
+def has_legacy_shards(root):
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return False
+    return any(len(name) == 2 and os.path.isdir(os.path.join(root, name)) for name in names)
+
+
+def read_marker(root):
+    try:
+        with open(os.path.join(root, MARKER)) as fp:
+            data = json.load(fp)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None, None
+        raise  # pragma: no cover
+    previous = data.get('previous')
+    return Layout.from_dict(root, data), previous and Layout.from_dict(root, previous)
+
+
+def write_marker(root, layout, previous=None):
+    data = layout.to_dict()
+    if previous:
+        data['previous'] = previous.to_dict()
+    try:
+        os.makedirs(root)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise  # pragma: no cover
+    name = os.path.join(root, MARKER)
+    # service processes start together and write same marker, each through own temp file
+    temp_name = '{}~{}'.format(name, os.getpid())
+    with open(temp_name, 'wt') as fp:
+        json.dump(data, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(temp_name, name)
+
+
+def open_layouts(root, layout, write=True):
+    # return target layout and previous one while migration is not finished,
+    # marker is written by service only, not by tools
+    current, previous = read_marker(root)
+    if current == layout:
+        return layout, previous
+    if current is None:
+        previous = Layout(root) if has_legacy_shards(root) else None
+    elif previous and previous != layout:
+        raise ValueError("Layout migration {} -> {} is not finished".format(previous, current))
+    else:
+        previous = current
+    if previous == layout:
+        previous = None
+    if previous:
+        LOGGER.warning("Change storage layout {} -> {}".format(previous, layout))
+    if write:
+        write_marker(root, layout, previous)
+    return layout, previous
+
+
+def link(src, dst, dir_mode):
+    path = os.path.dirname(dst)
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path, mode=dir_mode)
+        except OSError as e:  # pragma: no cover
+            if e.errno != errno.EEXIST:
+                raise
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def move(old_data, new_data, old_meta=None, new_meta=None, min_age=60, dir_mode=0o2710):
+    try:
+        # compressed data is stored as key.gz only
+        st = os.stat(old_meta or (old_data if os.path.exists(old_data) else old_data + '.gz'))
+        if time() - st.st_mtime < min_age:
+            return False
+        suffixes = [s for s in ('', '~', '.gz') if os.path.exists(old_data + s)]
+        for suffix in suffixes:
+            link(old_data + suffix, new_data + suffix, dir_mode)
+        if old_meta:
+            link(old_meta, new_meta, dir_mode)
+            os.unlink(old_meta)
+        for suffix in suffixes:
+            os.unlink(old_data + suffix)
+        return True
+    except (IOError, OSError) as e:
+        LOGGER.debug("Skip migration of {}: {}".format(old_data, e))
+        return False
+
+
+def migrate(old, new, key, min_age=60, dir_mode=0o2710, dirs=None, meta=True):
+    # move single key, data goes first so target meta always has data next to it
+    old_meta, old_data = old.paths(key, dirs)
+    new_meta, new_data = new.paths(key)
+    if not meta:
+        return move(old_data, new_data, min_age=min_age, dir_mode=dir_mode)
+    try:
+        fp = open(old_meta + '~', 'a')
+    except IOError:  # pragma: no cover
+        return False
+    try:
+        # same lock as in FilesStorage.save_meta
+        flock(fp, LOCK_EX | LOCK_NB)
+    except IOError:
+        fp.close()
+        return False
+    try:
+        return move(old_data, new_data, old_meta, new_meta, min_age, dir_mode)
+    finally:
+        os.unlink(old_meta + '~')
+        fp.close()
@@ -0,0 +1,150 @@
+import os
+import sys
+import sqlite3
+import simplejson as json
+from threading import Event, Lock
+from openprocurement.storage.files.index import scan_meta
+from openprocurement.storage.files.ingest import inline
+from openprocurement.storage.files.utils import pause
+from openprocurement.documentservice.utils import LOGGER
+
+
+class MetaDB(object):
+    # packed meta storage, writers which come within commit_delay share single commit;
+    # sqlite calls go through offload while caller holds the lock
+    def __init__(self, filename, commit_delay=0.002, mmap_size=0x10000000, timeout=30, offload=inline,
+                 new_lock=Lock):
+        self.filename = filename
+        self.offload = offload
+        self.commit_delay = commit_delay
+        self.mmap_size = mmap_size
+        self.timeout = timeout
+        self.db = None
+        self.lock = new_lock()
+        self.batch = self.new_batch()
+        self.counters = dict(reads=0, writes=0, commits=0)
+
+    def new_batch(self):
+        return dict(writes=0, event=Event(), error=None)
+
+    def connect(self):
+        path = os.path.dirname(self.filename)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        db = sqlite3.connect(self.filename, timeout=self.timeout, check_same_thread=False)
+        db.text_factory = str
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=FULL")
+        db.execute("PRAGMA mmap_size={:d}".format(self.mmap_size))
+        db.execute("CREATE TABLE IF NOT EXISTS meta (uuid TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        db.commit()
+        return db
+
+    def connection(self):
+        if self.db is None:
+            self.db = self.connect()
+        return self.db
+
+    def fetch(self, query, args):
+        return self.connection().execute(query, args).fetchall()
+
+    def execute_many(self, query, items):
+        db = self.connection()
+        return [db.execute(query, item).rowcount > 0 for item in items]
+
+    def sync(self):
+        self.connection().commit()
+
+    def read(self, uuid):
+        with self.lock:
+            rows = self.offload(self.fetch, "SELECT data FROM meta WHERE uuid=?", (uuid,))
+            self.counters['reads'] += 1
+        return rows[0][0] if rows else None
+
+    def exists(self, uuid):
+        with self.lock:
+            rows = self.offload(self.fetch, "SELECT 1 FROM meta WHERE uuid=?", (uuid,))
+        return bool(rows)
+
+    def write(self, uuid, data, overwrite=True):
+        return self.write_many([(uuid, data)], overwrite)[0]
+
+    def write_many(self, items, overwrite=True):
+        query = "INSERT OR REPLACE INTO meta VALUES (?, ?)" if overwrite else \
+                "INSERT OR IGNORE INTO meta VALUES (?, ?)"
+        with self.lock:
+            written = self.offload(self.execute_many, query, items)
+            batch = self.batch
+            batch['writes'] += len(items)
+            leader = batch['writes'] == len(items)
+        if leader:
+            if self.commit_delay:
+                pause(self.commit_delay)
+            self.commit()
+        else:
+            batch['event'].wait()
+        if batch['error']:
+            raise batch['error']
+        return written
+
+    def commit(self):
+        with self.lock:
+            batch, self.batch = self.batch, self.new_batch()
+            try:
+                self.offload(self.sync)
+            except sqlite3.Error as e:  # pragma: no cover
+                LOGGER.error("Meta commit failed: {}".format(e))
+                batch['error'] = e
+            self.counters['commits'] += 1
+            self.counters['writes'] += batch['writes']
+        batch['event'].set()
+
+    def scan(self, size=1000, offset=''):
+        while True:
+            with self.lock:
+                rows = self.offload(self.fetch, "SELECT uuid, data FROM meta WHERE uuid > ? "
+                                                "ORDER BY uuid LIMIT ?", (offset, size))
+            if not rows:
+                break
+            for uuid, data in rows:
+                yield uuid, data
+            offset = rows[-1][0]
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        if stats['commits']:
+            stats['writes_per_commit'] = round(float(stats['writes']) / stats['commits'], 2)
+        return stats
+
+
+def import_meta(metadb, save_path, batch_size=1000, overwrite=False):
+    count = 0
+    items = list()
+    for meta, stored in scan_meta(save_path):
+        items.append((meta['uuid'], json.dumps(meta)))
+        if len(items) >= batch_size:
+            count += sum(metadb.write_many(items, overwrite))
+            items = list()
+    if items:
+        count += sum(metadb.write_many(items, overwrite))
+    return count
+
+
+def main(argv=sys.argv):
+    from pyramid.paster import get_appsettings, setup_logging
+    args = [s for s in argv[1:] if s != '--overwrite']
+    if len(args) != 1:
+        print("usage: {} [--overwrite] config.ini\nImport .meta files of files.save_path "
+              "to files.meta_db".format(argv[0]))
+        return 1
+    setup_logging(args[0])
+    settings = get_appsettings(args[0])
+    save_path = settings['files.save_path'].strip()
+    metadb = MetaDB(settings.get('files.meta_db', os.path.join(save_path, 'meta.db')), commit_delay=0)
+    count = import_meta(metadb, save_path, overwrite='--overwrite' in argv)
+    LOGGER.info("Imported {} meta files".format(count))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+import re
+import socket
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+from time import time
+from openprocurement.documentservice.utils import LOGGER
+
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+NAME_RE = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def metric_name(*parts):
+    return NAME_RE.sub('_', '_'.join(parts))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                           for k, v in labels]) + '}'
+
+
+def timed(operation):
+    # total time of FilesStorage method, phases are timed inside
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer('operation', operation=operation, phase='total'):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StatsdSink(object):
+    # fire and forget udp, timings in ms, labels are joined to metric name
+    def __init__(self, address, prefix='files'):
+        host, port = address.rsplit(':', 1) if ':' in address else (address, 8125)
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def name(self, name, labels):
+        return '.'.join([self.prefix, name] + [NAME_RE.sub('_', str(v)) for k, v in labels])
+
+    def send(self, line):
+        try:
+            self.socket.sendto(line, self.address)
+        except socket.error as e:  # pragma: no cover
+            LOGGER.debug("Statsd send failed: {}".format(e))
+
+    def timing(self, name, labels, value):
+        self.send("{}:{:.3f}|ms".format(self.name(name, labels), value * 1000))
+
+    def incr(self, name, labels, value):
+        self.send("{}:{}|c".format(self.name(name, labels), value))
+
+
+class Metrics(object):
+    # in-process histograms and counters, rendered as prometheus text and
+    # forwarded to sinks with timing(name, labels, seconds) and incr(name, labels, value)
+    def __init__(self, sinks=(), buckets=BUCKETS):
+        self.sinks = list(sinks)
+        self.buckets = buckets
+        self.lock = Lock()
+        self.histograms = dict()
+        self.counters = dict()
+
+    def observe(self, name, value, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+        for sink in self.sinks:
+            sink.timing(name, labels, value)
+
+    def incr(self, name, value=1, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+        for sink in self.sinks:
+            sink.incr(name, labels, value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time()
+        try:
+            yield
+        finally:
+            self.observe(name, time() - started, **labels)
+
+    def render_stats(self, lines, prefix, value, labels=()):
+        # storage stats as gauges, dicts keyed by replica url become labels
+        if isinstance(value, dict):
+            for k, v in sorted(value.items()):
+                if '://' in k:
+                    self.render_stats(lines, prefix, v, labels + (('replica', k),))
+                else:
+                    self.render_stats(lines, metric_name(prefix, k), v, labels)
+        elif isinstance(value, (int, long, float)):
+            lines.append('{}{} {}'.format(prefix, format_labels(labels), float(value)))
+
+    def render(self, stats=None):
+        lines = list()
+        with self.lock:
+            histograms = sorted([(k, [list(v[0]), v[1], v[2]]) for k, v in self.histograms.items()])
+            counters = sorted(self.counters.items())
+        for (name, labels), (buckets, total, count) in histograms:
+            name = metric_name('files', name, 'seconds')
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), buckets):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+        for (name, labels), value in counters:
+            lines.append('{}{} {}'.format(metric_name('files', name, 'total'), format_labels(labels), value))
+        if stats:
+            self.render_stats(lines, 'files_stats', stats)
+        return '\n'.join(lines) + '\n'
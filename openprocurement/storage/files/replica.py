@@ -0,0 +1,284 @@
+import os
+import random
+import binascii
+from time import time
+from Queue import Queue
+from StringIO import StringIO
+from urlparse import parse_qsl
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.fields import RequestField
+from threading import Thread, Lock
+from openprocurement.storage.files.utils import pause
+from openprocurement.documentservice.utils import LOGGER
+
+
+class ReplicaError(Exception):
+    pass
+
+
+class ReplicaRejected(ReplicaError):
+    # replica is up but refused the file, retries won't help
+    pass
+
+
+# client errors which are worth retry
+RETRY_STATUS = frozenset([408, 429])
+
+
+class WorkerPool(object):
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.queue = Queue()
+        self.workers = list()
+        self.lock = Lock()
+
+    def worker(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                func(*args)
+            except Exception as e:  # pragma: no cover
+                LOGGER.error("Worker {} error: {}".format(func.__name__, e))
+            finally:
+                self.queue.task_done()
+
+    def spawn(self, func, *args):
+        with self.lock:
+            if len(self.workers) < self.size:
+                thread = Thread(target=self.worker, name="replica-{}".format(len(self.workers)))
+                thread.daemon = True
+                thread.start()
+                self.workers.append(thread)
+        self.queue.put((func, args))
+
+    def join(self):
+        self.queue.join()
+
+
+class ReplicaPools(object):
+    # workers of each replica, slow replica only delays its own uploads
+    def __init__(self, names, size, new_pool=WorkerPool):
+        self.size = max(1, size)
+        self.pools = dict([(name, new_pool(self.size)) for name in names])
+
+    def spawn(self, name, func, *args):
+        self.pools[name].spawn(func, *args)
+
+    def join(self):
+        for pool in self.pools.values():
+            pool.join()
+
+
+class MultipartFile(object):
+    def __init__(self, name, filename, content_type, in_file):
+        self.boundary = binascii.hexlify(os.urandom(16))
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+        field = RequestField(name=name, data='', filename=filename)
+        field.make_multipart(content_type=content_type)
+        headers = field.render_headers()
+        if isinstance(headers, unicode):
+            headers = headers.encode('utf-8')
+        preamble = '--{}\r\n{}'.format(self.boundary, headers)
+        epilogue = '\r\n--{}--\r\n'.format(self.boundary)
+        in_file.seek(0, os.SEEK_END)
+        self.length = len(preamble) + in_file.tell() + len(epilogue)
+        in_file.seek(0)
+        self.parts = [StringIO(preamble), in_file, StringIO(epilogue)]
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        chunks = list()
+        while self.parts:
+            block = self.parts[0].read(size)
+            if block:
+                chunks.append(block)
+                if size >= 0:
+                    size -= len(block)
+            if not block or size < 0:
+                self.parts.pop(0)
+            if size == 0:
+                break
+        return ''.join(chunks)
+
+
+class Replica(object):
+    options = dict(pool_size=int, connect_timeout=float, read_timeout=float, keepalive=float, down_time=float,
+                   retry_delay=float, retry_max_delay=float, retry_deadline=float, failure_threshold=int)
+
+    def __init__(self, url, pool_size=10, connect_timeout=10, read_timeout=300, keepalive=60, down_time=30,
+                 retry_delay=0.5, retry_max_delay=8, retry_deadline=30, failure_threshold=5):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keepalive = keepalive
+        self.down_time = down_time
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.retry_deadline = retry_deadline
+        self.failure_threshold = failure_threshold
+        # per replica options, ie http://host:port?pool_size=4&read_timeout=60
+        if "?" in url:
+            url, query = url.split("?", 1)
+            for k, v in parse_qsl(query):
+                if k not in self.options:
+                    raise ValueError("Unknown replica option {}".format(k))
+                setattr(self, k, self.options[k](v))
+        self.auth = None
+        schema = "http"
+        host = url
+        if "://" in host:
+            schema, host = host.split("://", 1)
+        if "@" in host:
+            auth, host = host.split('@', 1)
+            self.auth = tuple(auth.split(':', 1))
+        self.name = "{}://{}".format(schema, host)
+        self.post_url = "{}/upload".format(self.name)
+        self.timeout = (self.connect_timeout, self.read_timeout)
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        self.session = Session()
+        self.session.mount(self.name, self.adapter)
+        self.lock = Lock()
+        self.last_used = 0
+        # circuit breaker: closed -> open for down_time -> half-open single probe
+        self.state = 'closed'
+        self.down_until = 0
+        self.failed_attempts = 0
+        self.counters = dict(requests=0, failures=0, rejected=0, skipped=0, retries=0, trips=0,
+                             closed_connections=0, closed_requests=0)
+
+    def __repr__(self):
+        return "<Replica {}>".format(self.name)
+
+    def is_down(self):
+        return self.state == 'half-open' or self.state == 'open' and self.down_until > time()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and self.down_until <= time():
+                self.state = 'half-open'
+                return True
+            return False
+
+    def trip(self):
+        with self.lock:
+            if self.state != 'open':
+                self.counters['trips'] += 1
+            self.state = 'open'
+            self.down_until = time() + self.down_time
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.state = 'closed'
+                self.down_until = 0
+                self.failed_attempts = 0
+                return
+            self.failed_attempts += 1
+            tripped = self.state == 'half-open' or self.failed_attempts >= self.failure_threshold
+        if tripped:
+            self.trip()
+
+    def backoff(self, attempt):
+        # exponential with jitter, so concurrent uploads don't retry in lockstep
+        delay = min(self.retry_max_delay, self.retry_delay * 2 ** attempt)
+        return delay * random.uniform(0.5, 1)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def pool_stats(self):
+        connections = requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                connections += pool.num_connections
+                requests += pool.num_requests
+        return connections, requests
+
+    def close_idle(self):
+        # drop keep-alive connections which may be already closed by server
+        with self.lock:
+            if not self.last_used or time() - self.last_used < self.keepalive:
+                self.last_used = time()
+                return
+            self.last_used = time()
+            connections, requests = self.pool_stats()
+            self.counters['closed_connections'] += connections
+            self.counters['closed_requests'] += requests
+        self.adapter.close()
+
+    def post(self, body):
+        self.close_idle()
+        self.count('requests')
+        headers = {'Content-Type': body.content_type}
+        return self.session.post(self.post_url, auth=self.auth, data=body, headers=headers,
+                                 timeout=self.timeout)
+
+    def get_json(self, path, **params):
+        self.close_idle()
+        self.count('requests')
+        res = self.session.get(self.name + path, params=params, auth=self.auth, timeout=self.timeout)
+        res.raise_for_status()
+        return res.json()
+
+    def upload(self, uuid, filename, content_type, in_file, max_retry=10):
+        if not self.allow():
+            self.count('skipped')
+            raise ReplicaError("Replica {} is down".format(self.name))
+        # retry deadline limits time spent in backoff, single attempt is limited
+        # by connect and read timeouts only, so large files may take longer
+        slept = 0
+        for n in range(max_retry):
+            try:
+                # stream multipart body, don't build it in memory
+                body = MultipartFile('file', filename, content_type, in_file)
+                res = self.post(body)
+                if 400 <= res.status_code < 500 and res.status_code not in RETRY_STATUS:
+                    # replica answered, so it's healthy, only this file failed
+                    self.record(True)
+                    self.count('rejected')
+                    raise ReplicaRejected("Replica {} rejected {}: {} {}".format(
+                        self.name, uuid, res.status_code, res.reason))
+                res.raise_for_status()
+                if res.status_code == 200:
+                    data = res.json()
+                    get_url, get_params = data['get_url'].split('?', 1)
+                    get_host, replica_uuid = get_url.rsplit('/', 1)
+                    if uuid != replica_uuid:  # pragma: no cover
+                        raise ValueError("Salve uuid mismatch, verify secret_key")
+                    LOGGER.info("Upload {} to replica {}".format(uuid, self.post_url))
+                    self.record(True)
+                    return n + 1
+            except ReplicaRejected:
+                raise
+            except Exception as e:  # pragma: no cover
+                LOGGER.warning("Error {}/{} upload {} to {}: {}".format(n + 1, max_retry,
+                                uuid, self.post_url, e))
+                # breaker is tripped by failure_threshold only, not by single upload giving up
+                self.record(False)
+                delay = self.backoff(n)
+                # give up when retries or deadline are exhausted or breaker was tripped meanwhile
+                if n >= max_retry - 1 or slept + delay > self.retry_deadline or self.is_down():
+                    self.count('failures')
+                    raise
+                self.count('retries')
+                pause(delay)
+                slept += delay
+        raise ReplicaError("Unexpected replica response")  # pragma: no cover
+
+    def stats(self):
+        connections, requests = self.pool_stats()
+        with self.lock:
+            stats = dict(self.counters)
+        stats['connections'] = stats.pop('closed_connections') + connections
+        stats['reused'] = stats.pop('closed_requests') + requests - stats['connections']
+        stats['down'] = self.is_down()
+        stats['state'] = self.state
+        return stats
@@ -0,0 +1,268 @@
+import os
+import zlib
+import struct
+import tarfile
+from functools import partial
+from time import time
+from Queue import LifoQueue
+from StringIO import StringIO
+from magic import Magic
+from openprocurement.storage.files.cache import LRUCache
+from openprocurement.documentservice.utils import LOGGER
+
+try:
+    import libarchive
+except ImportError:  # pragma: no cover
+    libarchive = None
+
+try:
+    from gevent import get_hub
+    from gevent.monkey import is_module_patched
+except ImportError:  # pragma: no cover
+    get_hub = None
+
+
+ZIP_EOCD = struct.Struct('<4s4H2LH')
+ZIP_EOCD_SIG = 'PK\x05\x06'
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+ZIP64_LOCATOR_SIG = 'PK\x06\x07'
+ZIP64_EOCD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_EOCD_SIG = 'PK\x06\x06'
+ZIP_CDIR = struct.Struct('<4s6H3L5H2L')
+ZIP_CDIR_SIG = 'PK\x01\x02'
+ZIP_LOCAL = struct.Struct('<4s5H3L2H')
+ZIP_LOCAL_SIG = 'PK\x03\x04'
+
+ARCHIVE_TYPES = {
+    'zip': (('ZIP',), ('application/zip', 'application/x-zip-compressed')),
+    'tar': (('TAR', 'TGZ', 'TAR.GZ', 'TBZ2', 'TAR.BZ2'), ('application/x-tar', 'application/x-gtar')),
+    'rar': (('RAR',), ('application/x-rar', 'application/x-rar-compressed', 'application/vnd.rar')),
+    '7z': (('7Z',), ('application/x-7z-compressed',)),
+}
+
+
+class ScanBudgetExceeded(Exception):
+    pass
+
+
+class MagicPool(object):
+    # libmagic handles are not thread safe, each detection checks out own handle
+    def __init__(self, size=4, cache_size=10000, offload=True):
+        self.size = max(1, size)
+        self.handles = LifoQueue()
+        for n in range(self.size):
+            self.handles.put(Magic(mime=True))
+        self.cache = LRUCache(cache_size)
+        self.offload = offload and get_hub is not None and is_module_patched('threading')
+
+    def detect(self, buffer):
+        magic = self.handles.get()
+        try:
+            if self.offload:
+                # don't block gevent loop, run libmagic in native thread
+                return get_hub().threadpool.apply(magic.from_buffer, (buffer,))
+            return magic.from_buffer(buffer)
+        finally:
+            self.handles.put(magic)
+
+    def from_buffer(self, buffer, key=None):
+        if key:
+            mime = self.cache.get(key)
+            if mime:
+                return mime
+        mime = self.detect(buffer)
+        if key:
+            self.cache.set(key, mime)
+        return mime
+
+    def stats(self):
+        return dict(self.cache.stats(), handles=self.size, idle=self.handles.qsize(), offload=self.offload)
+
+
+class ForbiddenScanner(object):
+    def __init__(self, forbidden_ext, forbidden_mime, max_depth=2, max_entries=100000,
+                 max_bytes=0x4000000, timeout=10, strict=False):
+        self.forbidden_ext = frozenset([s.upper() for s in forbidden_ext])
+        self.forbidden_mime = frozenset([s.lower() for s in forbidden_mime])
+        self.archive_ext = dict([(e, k) for k, (exts, types) in ARCHIVE_TYPES.items() for e in exts])
+        self.archive_mime = dict([(m, k) for k, (exts, types) in ARCHIVE_TYPES.items() for m in types])
+        self.max_depth = max_depth
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.strict = strict
+
+    def check_name(self, filename):
+        for ext in filename.upper().rsplit('.', 2)[1:]:
+            if ext in self.forbidden_ext:
+                return True
+
+    def check_mime(self, mime):
+        return mime.lower() in self.forbidden_mime
+
+    def archive_type(self, filename, *mime_types):
+        exts = filename.upper().rsplit('.', 2)[1:]
+        if exts:
+            kind = self.archive_ext.get(exts[-1]) or self.archive_ext.get('.'.join(exts))
+            if kind:
+                return kind
+        for mime in mime_types:
+            if mime in self.archive_mime:
+                return self.archive_mime[mime]
+
+    def check_archive(self, fp, filename, *mime_types):
+        kind = self.archive_type(filename, *mime_types)
+        if not kind:
+            return
+        # bytes is the total of nested members read into memory and of
+        # compressed tar data decompressed to walk over members
+        budget = dict(entries=self.max_entries, bytes=self.max_bytes, deadline=time() + self.timeout)
+        try:
+            return self.scan(kind, fp, 0, budget)
+        except ScanBudgetExceeded as e:
+            # uploads were never rejected for size before, strict mode rejects
+            # since forbidden entry may be right after the cut-off
+            LOGGER.warning("Archive scan budget exceeded {}: {}".format(filename, e))
+            return self.strict
+
+    def scan(self, kind, fp, depth, budget):
+        if kind == 'zip':
+            entries = self.zip_entries(fp)
+        elif kind == 'tar':
+            entries = self.tar_entries(fp, budget)
+        elif libarchive:
+            entries = self.libarchive_entries(fp)
+        else:  # pragma: no cover
+            LOGGER.debug("Skip {} scan, libarchive is not installed".format(kind))
+            return
+        # set lookups are faster than a compiled regex on python 2
+        forbidden_ext = self.forbidden_ext
+        archive_ext = self.archive_ext if depth < self.max_depth else None
+        for name, read in entries:
+            budget['entries'] -= 1
+            if budget['entries'] < 0:
+                raise ScanBudgetExceeded("too many entries")
+            if time() > budget['deadline']:
+                raise ScanBudgetExceeded("timeout")
+            exts = name.upper().rsplit('.', 2)[1:]
+            for ext in exts:
+                if ext in forbidden_ext:
+                    return True
+            if archive_ext and read and exts:
+                nested = archive_ext.get(exts[-1]) or archive_ext.get('.'.join(exts))
+                if nested:
+                    data = read(budget['bytes'])
+                    if data is None:
+                        continue
+                    budget['bytes'] -= len(data)
+                    if self.scan(nested, StringIO(data), depth + 1, budget):
+                        return True
+
+    def zip_entries(self, fp):
+        # central directory only, don't parse whole archive
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        tail_size = min(size, ZIP_EOCD.size + 0xFFFF)
+        fp.seek(size - tail_size)
+        tail = fp.read(tail_size)
+        pos = tail.rfind(ZIP_EOCD_SIG)
+        if pos < 0 or len(tail) - pos < ZIP_EOCD.size:
+            return
+        eocd_offset = size - tail_size + pos
+        eocd = ZIP_EOCD.unpack(tail[pos:pos + ZIP_EOCD.size])
+        count, cdir_size, cdir_offset = eocd[4], eocd[5], eocd[6]
+        concat = eocd_offset - cdir_size - cdir_offset
+        if (count == 0xFFFF or cdir_offset == 0xFFFFFFFF) and pos >= ZIP64_LOCATOR.size:
+            locator = ZIP64_LOCATOR.unpack(tail[pos - ZIP64_LOCATOR.size:pos])
+            if locator[0] == ZIP64_LOCATOR_SIG:
+                fp.seek(locator[2])
+                eocd64 = ZIP64_EOCD.unpack(fp.read(ZIP64_EOCD.size))
+                if eocd64[0] != ZIP64_EOCD_SIG:
+                    return
+                count, cdir_size, cdir_offset = eocd64[7], eocd64[8], eocd64[9]
+                concat = 0
+        if cdir_size > self.max_bytes:
+            raise ScanBudgetExceeded("central directory too large")
+        fp.seek(cdir_offset + concat)
+        cdir = fp.read(cdir_size)
+        pos = 0
+        for n in xrange(count):
+            if len(cdir) - pos < ZIP_CDIR.size:
+                return
+            header = ZIP_CDIR.unpack_from(cdir, pos)
+            if header[0] != ZIP_CDIR_SIG:
+                return
+            pos += ZIP_CDIR.size
+            flags, method, csize, usize = header[3], header[4], header[8], header[9]
+            name = cdir[pos:pos + header[10]]
+            pos += header[10] + header[11] + header[12]
+            offset = header[16] + concat
+            if not flags & 1 and method in (0, 8) and usize <= self.max_bytes:
+                yield name, partial(self.zip_read, fp, offset, method, csize)
+            else:
+                yield name, None
+
+    def zip_read(self, fp, offset, method, csize, limit):
+        if method == 0 and csize > limit:
+            raise ScanBudgetExceeded("too many bytes")
+        try:
+            fp.seek(offset)
+            header = ZIP_LOCAL.unpack(fp.read(ZIP_LOCAL.size))
+            if header[0] != ZIP_LOCAL_SIG:
+                return
+            fp.seek(header[9] + header[10], os.SEEK_CUR)
+            data = fp.read(min(csize, limit))
+            if method == 8:
+                decompress = zlib.decompressobj(-15)
+                data = decompress.decompress(data, limit)
+                if decompress.unconsumed_tail or csize > limit:
+                    raise ScanBudgetExceeded("too many bytes")
+            return data
+        except (struct.error, zlib.error):
+            return
+
+    def tar_entries(self, fp, budget):
+        fp.seek(0)
+        try:
+            tar = tarfile.open(fileobj=fp, mode='r:*')
+        except (tarfile.TarError, EOFError, IOError, zlib.error):
+            return
+        # next header of compressed tar is reached only by decompressing
+        # data of every member before it, even of skipped ones
+        compressed = tar.fileobj is not fp
+        passed = 0
+        try:
+            while True:
+                member = tar.next()
+                if member is None:
+                    break
+                read = None
+                if member.isfile() and member.size <= self.max_bytes:
+                    read = partial(self.tar_read, tar, member)
+                yield member.name, read
+                if compressed:
+                    end = member.offset_data + member.size
+                    budget['bytes'] -= end - passed
+                    passed = end
+                    if budget['bytes'] < 0:
+                        raise ScanBudgetExceeded("too many bytes")
+        except (tarfile.TarError, EOFError, IOError, zlib.error):
+            return
+
+    def tar_read(self, tar, member, limit):
+        if member.size > limit:
+            raise ScanBudgetExceeded("too many bytes")
+        return tar.extractfile(member).read(limit)
+
+    def libarchive_entries(self, fp):
+        fp.seek(0)
+        try:
+            if hasattr(fp, 'fileno'):
+                reader = libarchive.fd_reader(fp.fileno())
+            else:
+                reader = libarchive.memory_reader(fp.read(self.max_bytes))
+            with reader as archive:
+                for entry in archive:
+                    yield entry.pathname, None
+        except libarchive.ArchiveError:
+            return
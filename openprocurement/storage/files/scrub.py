@@ -0,0 +1,331 @@
+import os
+import re
+import sys
+import mmap
+import ctypes
+import errno
+import zlib
+import hashlib
+import simplejson as json
+from multiprocessing.pool import ThreadPool
+from threading import Lock, Thread
+from time import time
+from uuid import uuid4
+from openprocurement.storage.files.archive import Throttle
+from openprocurement.storage.files.utils import CounterMixin, get_now, load_libc, pause
+from openprocurement.documentservice.storage import KeyNotFound
+from openprocurement.documentservice.utils import LOGGER
+
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+
+def libc_fadvise():
+    try:
+        func = load_libc().posix_fadvise64
+    except AttributeError:  # pragma: no cover
+        return
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    func.restype = ctypes.c_int
+
+    def fadvise(fd, offset, length, advice):
+        func(fd, offset, length, advice)
+
+    return fadvise
+
+
+def libc_mincore():
+    try:
+        libc = load_libc()
+        func = libc.mincore
+        libc_mmap, munmap = libc.mmap, libc.munmap
+    except AttributeError:  # pragma: no cover
+        return
+    libc_mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                          ctypes.c_int64]
+    libc_mmap.restype = ctypes.c_void_p
+    munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    func.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+    func.restype = ctypes.c_int
+
+    def mincore(fd, size):
+        # page cache residency of file, one byte per page with lowest bit set if resident
+        if not size:
+            return ''
+        pages = ctypes.create_string_buffer((size + mmap.PAGESIZE - 1) // mmap.PAGESIZE)
+        addr = libc_mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr in (None, ctypes.c_void_p(-1).value):
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        try:
+            if func(addr, size, pages):
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        finally:
+            munmap(addr, size)
+        return pages.raw
+
+    return mincore
+
+
+# python 2 has no os.posix_fadvise
+fadvise = getattr(os, 'posix_fadvise', None) or libc_fadvise()
+mincore = libc_mincore()
+
+# page residency bytes mapped to '1' for cached and '0' for not cached pages
+RESIDENT = ''.join(str(n & 1) for n in range(256))
+
+
+def cold_ranges(pages, pagesize=mmap.PAGESIZE):
+    # (offset, length) of pages which were not in page cache
+    for match in re.finditer('0+', pages.translate(RESIDENT)):
+        yield match.start() * pagesize, (match.end() - match.start()) * pagesize
+
+
+# top level directories which are not a part of shard tree
+SKIP_DIRS = frozenset(['chunks', 'quarantine'])
+
+
+class Scrubber(CounterMixin):
+    # verify stored files against meta hash, resumable and rate limited
+    def __init__(self, storage, rate=0x2000000, workers=2, batch=64, stale_age=86400,
+                 blocksize=0x100000, state_name=None, walk_cost=0x1000):
+        self.storage = storage
+        self.throttle = Throttle(rate)
+        # bytes charged to throttle for every directory entry in cleanup walk
+        self.walk_cost = walk_cost
+        self.throttle_lock = Lock()
+        self.workers = max(1, workers)
+        self.batch = batch
+        self.stale_age = stale_age
+        self.blocksize = blocksize
+        self.state_name = state_name or os.path.join(storage.save_path, 'scrub.json')
+        self.quarantine_path = os.path.join(storage.save_path, 'quarantine')
+        self.lock = Lock()
+        self.counters = dict(files=0, bytes=0, ok=0, mismatch=0, missing=0, errors=0,
+                             stale_removed=0, passes=0)
+
+    def load_state(self):
+        try:
+            with open(self.state_name) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return dict()
+
+    def save_state(self, state):
+        with open(self.state_name + '~', 'wt') as fp:
+            json.dump(state, fp)
+        os.rename(self.state_name + '~', self.state_name)
+
+    def entries(self, position=None):
+        # yield (position, meta, data file name) in stable order
+        storage = self.storage
+        if storage.meta_db:
+            for uuid, data in storage.meta_db.scan(offset=position or ''):
+                yield uuid, json.loads(data), None
+            return
+        for n, layout in enumerate(filter(None, [storage.layout, storage.old_layout])):
+            for dirs, key in layout.walk():
+                current = '{}:{}'.format(n, '/'.join(dirs + (key,)))
+                if position and current <= position:
+                    continue
+                meta_name, data_name = layout.paths(key, dirs)
+                try:
+                    with open(meta_name) as fp:
+                        meta = json.load(fp)
+                except (IOError, ValueError) as e:
+                    LOGGER.error("Can't read {}: {}".format(meta_name, e))
+                    self.count(errors=1)
+                    continue
+                yield current, meta, data_name
+
+    def read(self, size):
+        with self.throttle_lock:
+            self.throttle(size)
+
+    def cached_pages(self, fd):
+        if not fadvise or not mincore:
+            return
+        try:
+            return mincore(fd, os.fstat(fd).st_size)
+        except (EnvironmentError, ValueError):  # pragma: no cover
+            return
+
+    def digest(self, name):
+        md5hash = hashlib.md5()
+        decompress = None
+        try:
+            fd = os.open(name, os.O_RDONLY)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # compressed data is stored as name.gz only, hash its content
+            fd = os.open(name + '.gz', os.O_RDONLY)
+            decompress = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            # pages cached before scrub are left in page cache
+            cached = self.cached_pages(fd)
+            if fadvise:
+                fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+            while True:
+                block = os.read(fd, self.blocksize)
+                if not block:
+                    break
+                md5hash.update(decompress.decompress(block) if decompress else block)
+                self.count(bytes=len(block))
+                self.read(len(block))
+            if decompress:
+                md5hash.update(decompress.flush())
+            if cached is not None:
+                for offset, length in cold_ranges(cached):
+                    fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+        return "md5:" + md5hash.hexdigest()
+
+    def verify(self, entry):
+        position, meta, name = entry
+        if 'filename' not in meta or meta.get('archived') or meta.get('quarantined'):
+            return
+        uuid = meta['uuid']
+        if name is None:
+            name = self.storage.locate(uuid)[2]
+        try:
+            md5hash = self.storage.offload(self.digest, name)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                self.count(missing=1)
+                LOGGER.warning("Scrub {} file missing".format(uuid))
+            else:
+                self.count(errors=1)
+                LOGGER.error("Scrub {} error: {}".format(uuid, e))
+            return
+        except zlib.error as e:
+            # damaged name.gz, content can't be hashed
+            LOGGER.error("Scrub {} gzip error: {}".format(uuid, e))
+            md5hash = None
+        self.count(files=1)
+        if md5hash == meta['hash']:
+            self.count(ok=1)
+            return
+        self.count(mismatch=1)
+        LOGGER.error("Scrub {} hash mismatch {} != {}".format(uuid, md5hash, meta['hash']))
+        try:
+            self.quarantine(uuid, name, md5hash)
+        except (IOError, OSError, KeyNotFound) as e:  # pragma: no cover
+            LOGGER.error("Can't quarantine {}: {}".format(uuid, e))
+
+    def quarantine(self, uuid, name, md5hash):
+        # keep damaged file for investigation, same content may be uploaded again
+        storage = self.storage
+        if not os.path.exists(self.quarantine_path):
+            os.makedirs(self.quarantine_path, mode=storage.dir_mode)
+        # same data file may be quarantined again after upload heals it
+        target = os.path.join(self.quarantine_path, '{}.{}'.format(os.path.basename(name), uuid4().hex))
+        if os.path.exists(name):
+            os.rename(name, target)
+            if os.path.exists(name + '.gz'):
+                os.unlink(name + '.gz')
+        else:
+            target += '.gz'
+            os.rename(name + '.gz', target)
+        with storage.meta_lock:
+            meta = storage.read_meta(uuid)
+            meta.pop('gzip', None)
+            meta['quarantined'] = dict(hash=md5hash, path=target, modified=get_now().isoformat())
+            storage.save_meta(uuid, meta, overwrite=True)
+        if storage.index:
+            storage.index.set(meta['hash'], uuid, stored=False)
+
+    def cleanup(self):
+        # remove temp files left by crashed writers and failed replica uploads
+        removed = 0
+        deadline = time() - self.stale_age
+        for path, dirs, files in os.walk(self.storage.save_path):
+            if path == self.storage.save_path:
+                dirs[:] = [s for s in dirs if s not in SKIP_DIRS]
+            self.read(self.walk_cost * (1 + len(dirs) + len(files)))
+            for name in files:
+                if not name.endswith('~'):
+                    continue
+                name = os.path.join(path, name)
+                try:
+                    if os.path.getmtime(name) < deadline:
+                        os.unlink(name)
+                        removed += 1
+                        LOGGER.info("Removed stale {}".format(name))
+                except OSError:  # pragma: no cover
+                    continue
+        self.count(stale_removed=removed)
+        return removed
+
+    def run(self, limit=0):
+        state = self.load_state()
+        position = state.get('position')
+        self.throttle.reset()
+        if not position:
+            self.storage.offload(self.cleanup)
+            state = dict(started=time())
+        pool = ThreadPool(self.workers)
+        checked = 0
+        try:
+            batch = list()
+            for entry in self.entries(position):
+                batch.append(entry)
+                if len(batch) < self.batch:
+                    continue
+                pool.map(self.verify, batch)
+                checked += len(batch)
+                state['position'] = batch[-1][0]
+                self.save_state(state)
+                batch = list()
+                if limit and checked >= limit:
+                    return checked
+            pool.map(self.verify, batch)
+            checked += len(batch)
+        finally:
+            pool.close()
+            pool.join()
+        state.update(position=None, finished=time())
+        self.save_state(state)
+        self.count(passes=1)
+        return checked
+
+    def loop(self, interval):
+        while True:
+            try:
+                LOGGER.info("Scrub checked {} files".format(self.run()))
+            except Exception as e:  # pragma: no cover
+                LOGGER.error("Scrub error: {}".format(e))
+            pause(interval)
+
+    def start(self, interval):
+        thread = Thread(target=self.loop, args=(interval,), name="scrubber")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        state = self.load_state()
+        stats.update(position=state.get('position'), finished=state.get('finished'))
+        return stats
+
+
+def main(argv=sys.argv):
+    from pyramid.paster import get_appsettings, setup_logging
+    from openprocurement.storage.files.storage import FilesStorage
+    if len(argv) != 2:
+        print("usage: {} config.ini\nVerify stored files against meta hash, "
+              "continue from last position".format(argv[0]))
+        return 1
+    setup_logging(argv[1])
+    settings = get_appsettings(argv[1])
+    settings['files.background_workers'] = 'false'
+    scrubber = FilesStorage(settings).scrubber
+    scrubber.run()
+    LOGGER.info("Scrub {}".format(scrubber.stats()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
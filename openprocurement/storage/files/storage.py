@@ -1,28 +1,49 @@
 import os
+import errno
 import hashlib
-import zipfile
+import gzip
 import simplejson as json
+from copy import deepcopy
+from functools import partial
 from hmac import compare_digest
 from fcntl import flock, LOCK_EX, LOCK_NB
-from magic import Magic
-from time import sleep
-from datetime import datetime
-from pytz import timezone
+from Queue import Empty, Queue
+from threading import Lock, Thread
+from time import time
+from email.utils import formatdate
 from rfc6266 import build_header
-from requests import Session
-from shutil import copyfileobj
+from pyramid.settings import asbool
 from urllib import quote
+from openprocurement.storage.files.archive import Archiver
+from openprocurement.storage.files.cache import LRUCache
+from openprocurement.storage.files.chunks import ChunkedUploads
+from openprocurement.storage.files.compress import SizedFile, data_exists, write_sibling
 from openprocurement.storage.files.dangerous import DANGEROUS_EXT, DANGEROUS_MIME_TYPES
+from openprocurement.storage.files.hashing import MultiHash
+from openprocurement.storage.files.index import HashIndex, scan_meta
+from openprocurement.storage.files.ingest import StreamIngest
+from openprocurement.storage.files.journal import ReplicationJournal
+from openprocurement.storage.files.layout import Layout, open_layouts, migrate, write_marker
+from openprocurement.storage.files.metadb import MetaDB
+from openprocurement.storage.files.replica import Replica, ReplicaError, ReplicaRejected, ReplicaPools, WorkerPool
+from openprocurement.storage.files.metrics import Metrics, StatsdSink, timed
+from openprocurement.storage.files.scanner import ForbiddenScanner, MagicPool
+from openprocurement.storage.files.scrub import Scrubber
+from openprocurement.storage.files.sync import AntiEntropy
+from openprocurement.storage.files.utils import get_now, pause
 from openprocurement.documentservice.storage import (HashInvalid, KeyNotFound, ContentUploaded,
     StorageUploadError, get_filename)
 from openprocurement.documentservice.utils import LOGGER
 
 
-TZ = timezone(os.environ['TZ'] if 'TZ' in os.environ else 'Europe/Kiev')
-
-
-def get_now():
-    return datetime.now(TZ)
+def read_meta_file(name, cached=None):
+    # returns (signature, data), cached is valid while file is not replaced
+    st = os.stat(name)
+    signature = (st.st_ino, st.st_mtime, st.st_size)
+    if cached and cached[0] == signature:
+        return cached
+    with open(name) as fp:
+        return signature, fp.read()
 
 
 class FilesStorage:
@@ -31,6 +52,16 @@ class FilesStorage:
         self.archive_web_root = self.web_root + '.archive'
         self.save_path = settings['files.save_path'].strip()
         self.secret_key = settings['files.secret_key'].strip()
+        # one-shot tools run without migration, journal, archive, scrub and sync threads
+        self.background = asbool(settings.get('files.background_workers', True))
+        self.uuid_salt = ':uuid:' + self.secret_key
+        self.file_salt = ':file:' + self.secret_key
+        self.metrics = Metrics()
+        if 'files.metrics_statsd' in settings:
+            self.metrics.sinks.append(StatsdSink(settings['files.metrics_statsd'].strip(),
+                                                 prefix=settings.get('files.metrics_prefix', 'files')))
+        self.locations = dict()
+        self.locations_size = int(settings.get('files.locations_cache_size', 10000))
         self.disposition = settings.get('files.disposition', 'inline')
         forbidden_ext = settings.get('files.forbidden_ext', DANGEROUS_EXT)
         self.forbidden_ext = set([s.strip().upper() for s in forbidden_ext.split(',') if s.strip()])
@@ -42,6 +73,13 @@ class FilesStorage:
         if 'files.forbidden_hash' in settings:
             with open(settings['files.forbidden_hash']) as fp:
                 self.forbidden_hash = set([s.strip().lower() for s in fp.readlines() if s.startswith("md5:")])
+        self.scanner = ForbiddenScanner(
+            self.forbidden_ext, self.forbidden_mime,
+            max_depth=int(settings.get('files.scan_max_depth', 2)),
+            max_entries=int(settings.get('files.scan_max_entries', 100000)),
+            max_bytes=int(settings.get('files.scan_max_bytes', 0x4000000)),
+            timeout=float(settings.get('files.scan_timeout', 10)),
+            strict=asbool(settings.get('files.scan_strict', False)))
         if 'files.get_url_expire' in settings:
             # dirty monkey pathing
             from openprocurement.documentservice import views
@@ -53,142 +91,620 @@ class FilesStorage:
         if 'files.replica_api' in settings:
             self.replica_apis = [s.strip() for s in settings['files.replica_api'].split(',') if s.strip()]
         self.require_replica_upload = settings.get('files.require_replica_upload', True)
-        self.replica_timeout = 300
-        self.magic = Magic(mime=True)
-        self.session = Session()
+        replica_options = dict([(k, v(settings['files.replica_' + k]))
+                                for k, v in Replica.options.items() if 'files.replica_' + k in settings])
+        self.replica_quorum = int(settings.get('files.replica_quorum', len(self.replica_apis)))
+        self.replica_workers = int(settings.get('files.replica_workers', 4 * len(self.replica_apis)))
+        # bytes per second, 0 waits for quorum without time limit
+        self.replica_min_rate = float(settings.get('files.replica_min_rate', 0x100000))
+        self.magic = MagicPool(
+            size=int(settings.get('files.magic_pool_size', 4)),
+            cache_size=int(settings.get('files.magic_cache_size', 10000)),
+            offload=asbool(settings.get('files.magic_offload', True)))
+        self.replicas = [Replica(s, **replica_options) for s in self.replica_apis]
+        self.replica_names = dict([(r.name, r) for r in self.replicas])
+        # files.replica_workers is split between replicas
+        self.replica_pool = ReplicaPools(self.replica_names, self.replica_workers // max(1, len(self.replicas)))
+        self.meta_lock = self.new_lock()
+        self.meta_cache = LRUCache(int(settings.get('files.meta_cache_size', 1000)))
+        self.meta_db = None
+        if settings.get('files.meta_backend', 'file') == 'sqlite':
+            self.meta_db = MetaDB(
+                settings.get('files.meta_db', os.path.join(self.save_path, 'meta.db')),
+                commit_delay=float(settings.get('files.meta_commit_delay', 0.002)),
+                offload=self.offload, new_lock=self.new_lock)
         self.dir_mode = 0o2710
         self.file_mode = 0o440
         self.meta_mode = 0o400
+        hash_algorithms = settings.get('files.hash_algorithms', 'md5,sha256')
+        self.ingest = StreamIngest(
+            os.path.join(self.save_path, 'ingest'),
+            dir_mode=self.dir_mode,
+            zero_copy=asbool(settings.get('files.ingest_zero_copy', True)),
+            blocksize=int(settings.get('files.ingest_blocksize', 0x100000)),
+            algorithms=[s.strip() for s in hash_algorithms.split(',') if s.strip()],
+            chunk_size=int(settings.get('files.hash_chunk_size', 0x800000)),
+            parallel_min=int(settings.get('files.hash_parallel_min', 0x800000)))
+        self.layout, self.old_layout = open_layouts(
+            self.save_path, Layout.from_settings(self.save_path, settings), write=self.background)
+        self.migration = dict(moved=0, skipped=0, passes=0)
+        if self.background and self.old_layout and asbool(settings.get('files.layout_migrate', False)):
+            self.migrate_rate = float(settings.get('files.layout_migrate_rate', 100))
+            self.migrate_min_age = float(settings.get('files.layout_migrate_min_age', 60))
+            self.migration_thread = Thread(target=self.migration_loop, name="layout-migrate")
+            self.migration_thread.daemon = True
+            self.migration_thread.start()
+        self.compress = asbool(settings.get('files.compress', False))
+        self.compress_min_size = int(settings.get('files.compress_min_size', 1024))
+        self.compress_level = int(settings.get('files.compress_level', 6))
+        self.compress_ratio = float(settings.get('files.compress_ratio', 0.9))
+        self.compress_pool = WorkerPool(int(settings.get('files.compress_workers', 2)))
+        self.chunks = ChunkedUploads(
+            os.path.join(self.save_path, 'chunks'),
+            dir_mode=self.dir_mode,
+            max_size=int(settings.get('files.chunks_max_size', 0x100000000)),
+            max_age=int(settings.get('files.chunks_max_age', 86400)),
+            new_hash=self.ingest.new_hash,
+            offload=self.offload, new_lock=self.new_lock)
+        self.stats_lock = Lock()
+        self.dedup = dict(uploads=0, duplicates=0, bytes_saved=0)
+        self.compressed = dict(files=0, skipped=0, bytes_in=0, bytes_out=0)
+        self.index = None
+        if asbool(settings.get('files.hash_index', False)):
+            self.index = HashIndex(os.path.join(self.save_path, 'hashes.db'),
+                                   offload=self.offload, new_lock=self.new_lock)
+            if not self.index.is_complete() and next(self.scan_meta(), None) is None:
+                # index created with empty store gets every hash
+                self.index.set_complete()
+        self.journal = None
+        if settings.get('files.replica_mode', 'sync') == 'async' and self.replicas:
+            self.journal = ReplicationJournal(
+                os.path.join(self.save_path, 'journal'),
+                retry_delay=int(settings.get('files.replica_retry_delay', 10)),
+                dir_mode=self.dir_mode,
+                offload=self.offload)
+            self.journal_poll = float(settings.get('files.replica_journal_poll', 5))
+            if self.background:
+                self.journal_thread = Thread(target=self.replication_loop, name="replica-journal")
+                self.journal_thread.daemon = True
+                self.journal_thread.start()
+        self.archiver = None
+        if 'files.archive_path' in settings:
+            self.archiver = Archiver(
+                self, settings['files.archive_path'].strip(),
+                after=float(settings.get('files.archive_after', 365)),
+                rate=int(settings.get('files.archive_rate', 0x1000000)),
+                compress=asbool(settings.get('files.archive_compress', True)),
+                restore_on_access=asbool(settings.get('files.archive_restore_on_access', False)))
+            if self.background and float(settings.get('files.archive_interval', 0)):
+                self.archiver.start(float(settings['files.archive_interval']))
+        self.scrubber = Scrubber(
+            self,
+            rate=int(settings.get('files.scrub_rate', 0x2000000)),
+            workers=int(settings.get('files.scrub_workers', 2)),
+            stale_age=int(settings.get('files.scrub_stale_age', 86400)))
+        self.scrub_interval = float(settings.get('files.scrub_interval', 0))
+        if self.background and self.scrub_interval:
+            self.scrubber.start(self.scrub_interval)
+        self.sync = AntiEntropy(
+            self,
+            rate=int(settings.get('files.sync_rate', 0x2000000)),
+            workers=int(settings.get('files.sync_workers', 4)),
+            cache_ttl=float(settings.get('files.sync_cache_ttl', 60)))
+        if self.background and self.replicas and float(settings.get('files.sync_interval', 0)):
+            self.sync.start(float(settings['files.sync_interval']))
+
+    def new_lock(self):
+        # lock which may be held across offload
+        return Lock()
+
+    def offload(self, func, *args):
+        # disk and cpu bound work, cooperative backend runs it in native threads
+        return func(*args)
+
+    def timer(self, operation, phase):
+        return self.metrics.timer('operation', operation=operation, phase=phase)
 
-    def web_location(self, key, archived=False):
-        web_root = self.web_root if not archived else self.archive_web_root
-        return os.path.join(web_root, key[-2:], key[-4:], key).encode()
+    def web_location(self, key, archived=False, layout=None):
+        web_root = self.web_root
+        if archived:
+            # archive volume is managed outside and keeps legacy key[-2:]/key[-4:]/key tree
+            web_root, layout = self.archive_web_root, Layout(self.save_path)
+        return os.path.join(web_root, *(layout or self.layout).data_parts(key)).encode()
 
     def file_path(self, key):
-        path = os.path.join(self.save_path, key[-2:], key[-4:])
-        return path, os.path.join(path, key)
+        # compatibility, data file in current layout
+        name = self.layout.paths(key)[1]
+        return os.path.dirname(name), name
 
     def hash_to_uuid(self, md5hash):
-        return hashlib.sha1(md5hash + ':uuid:' + self.secret_key).hexdigest()
+        return hashlib.sha1(md5hash + self.uuid_salt).hexdigest()
 
     def uuid_to_file(self, uuid):
-        return hashlib.sha1(uuid + ':file:' + self.secret_key).hexdigest()
+        return hashlib.sha1(uuid + self.file_salt).hexdigest()
 
-    def save_meta(self, uuid, meta, overwrite=False):
+    def resolve(self, uuid):
+        try:
+            return self.locations[uuid]
+        except KeyError:
+            pass
         key = self.uuid_to_file(uuid)
-        path, name = self.file_path(key)
-        name += '.meta'
-        if not overwrite and os.path.exists(name):
-            raise ContentUploaded(uuid)
-        meta['modified'] = get_now().isoformat()
-        if not os.path.exists(path):
-            os.makedirs(path, mode=self.dir_mode)
-        with open(name + '~', 'wt') as fp:
-            flock(fp, LOCK_EX | LOCK_NB)
-            json.dump(meta, fp)
-        os.rename(name + '~', name)
-        os.chmod(name, self.meta_mode)
+        location = (key,) + self.layout.paths(key)
+        # derivation is pure, so simply drop all when full
+        if len(self.locations) >= self.locations_size:
+            self.locations.clear()
+        self.locations[uuid] = location
+        return location
+
+    def locate(self, uuid):
+        # while migration is in progress file may be found in previous layout
+        location = self.resolve(uuid)
+        old_layout = self.old_layout
+        # packed meta has no files to probe, check data file instead
+        probe = 2 if self.meta_db else 1
+        exists = data_exists if probe == 2 else os.path.exists
+        if old_layout is None or exists(location[probe]):
+            return location + (self.layout,)
+        key = location[0]
+        old_location = (key,) + old_layout.paths(key)
+        if exists(old_location[probe]):
+            return old_location + (old_layout,)
+        return location + (self.layout,)
+
+    def save_meta(self, uuid, meta, overwrite=False, create_path=True):
+        if self.meta_db:
+            meta['modified'] = get_now().isoformat()
+            if not self.meta_db.write(uuid, json.dumps(meta), overwrite):
+                raise ContentUploaded(uuid)
+            return
+        self.offload(self.write_meta, uuid, meta, overwrite, create_path)
+        self.meta_cache.pop(uuid)
+
+    def write_meta(self, uuid, meta, overwrite, create_path):
+        for attempt in range(10):
+            key, name, data, layout = self.locate(uuid)
+            path = os.path.dirname(name)
+            if not overwrite and os.path.exists(name):
+                raise ContentUploaded(uuid)
+            meta['modified'] = get_now().isoformat()
+            if create_path and not os.path.exists(path):
+                os.makedirs(path, mode=self.dir_mode)
+            fp = open(name + '~', 'wt')
+            try:
+                flock(fp, LOCK_EX | LOCK_NB)
+            except IOError:
+                fp.close()
+                if layout is self.layout or attempt == 9:
+                    raise
+                # layout migration holds the lock
+                pause(0.01)
+                continue
+            if layout is not self.layout and self.locate(uuid)[1] != name:
+                # moved by migration between locate and lock
+                fp.close()
+                os.unlink(name + '~')
+                continue
+            with fp:
+                json.dump(meta, fp)
+            os.rename(name + '~', name)
+            os.chmod(name, self.meta_mode)
+            return
 
     def read_meta(self, uuid):
-        key = self.uuid_to_file(uuid)
-        path, name = self.file_path(key)
-        name += '.meta'
-        if not os.path.exists(name):
-            raise KeyNotFound(uuid)  # pragma: no cover
-        with open(name) as fp:
-            return json.load(fp)
+        if self.meta_db:
+            data = self.meta_db.read(uuid)
+            if data is None:
+                raise KeyNotFound(uuid)
+            return json.loads(data)
+        key, name, data, layout = self.locate(uuid)
+        # cached meta is kept serialized because loads is cheaper than deepcopy and callers modify meta
+        cached = self.meta_cache.get(uuid)
+        try:
+            entry = self.offload(read_meta_file, name, cached)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise  # pragma: no cover
+            if layout is self.layout:
+                raise KeyNotFound(uuid)
+            # moved by layout migration after locate
+            return self.read_meta(uuid)
+        if entry is not cached:
+            self.meta_cache.set(uuid, entry)
+        return json.loads(entry[1])
 
-    def check_forbidden(self, filename, content_type, fp):
-        for ext in filename.rsplit('.', 2)[1:]:
-            if ext.upper() in self.forbidden_ext:
-                return True
-        if content_type.lower() in self.forbidden_mime:
+    def check_forbidden(self, filename, content_type, fp, header=None, md5hash=None):
+        if self.scanner.check_name(filename):
             return True
-        fp.seek(0)
-        magic_type = self.magic.from_buffer(fp.read(2048))
-        if magic_type.lower() in self.forbidden_mime:
+        if self.scanner.check_mime(content_type):
             return True
-        if filename.upper().endswith('.ZIP') or \
-                'application/zip' in (content_type, magic_type):
+        if header is None:
             fp.seek(0)
-            try:
-                zipobj = zipfile.ZipFile(fp)
-            except zipfile.BadZipfile:
-                return
-            for filename in zipobj.namelist():
-                for ext in filename.rsplit('.', 2)[1:]:
-                    if ext.upper() in self.forbidden_ext:
-                        return True
+            header = fp.read(2048)
+        magic_type = self.magic.from_buffer(header, md5hash)
+        if self.scanner.check_mime(magic_type):
+            return True
+        # archive scan may take up to scan_timeout
+        return self.offload(self.scanner.check_archive, fp, filename, content_type, magic_type)
 
-    def compute_md5(self, in_file, blocksize=0x10000):
+    def compute_md5(self, in_file, blocksize=None):
         in_file.seek(0)
-        md5hash = hashlib.md5()
+        hasher = MultiHash()
         while True:
-            block = in_file.read(blocksize)
+            block = in_file.read(blocksize or self.ingest.blocksize)
             if not block or not len(block):
                 break
-            md5hash.update(block)
-        return "md5:" + md5hash.hexdigest()
+            hasher.update(block)
+        return "md5:" + hasher.close()[0]['md5']
 
-    def upload_to_replicas(self, post_file, uuid, max_retry=10):
+    def add_digests(self, meta, staged):
+        # extra digests and chunk digests for later verification and chunk level dedup
+        changed = False
+        for name, value in staged.digests.items():
+            if name != 'md5' and meta.get(name) != value:
+                meta[name] = value
+                changed = True
+        if staged.chunks and 'chunks' not in meta:
+            meta['chunks'] = dict(size=self.ingest.chunk_size, algorithm='sha256', digests=staged.chunks)
+            changed = True
+        return changed
+
+    def open_data(self, uuid, name, meta=None):
+        # compressed data is stored as name.gz only
+        try:
+            return open(name, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        in_file = gzip.open(name + '.gz', 'rb')
+        return SizedFile(in_file, (meta or self.read_meta(uuid)).get('size'))
+
+    def save_replica_state(self, uuid, replica, state):
+        with self.meta_lock:
+            meta = self.read_meta(uuid)
+            if 'replicas' not in meta:
+                meta['replicas'] = dict()
+            meta['replicas'][replica.name] = state
+            self.save_meta(uuid, meta, overwrite=True)
+
+    def upload_to_replica(self, replica, uuid, filename, content_type, results, max_retry=10):
+        key, meta_name, name, layout = self.locate(uuid)
+        try:
+            with self.open_data(uuid, name) as in_file, self.metrics.timer('replica', replica=replica.name):
+                attempts = replica.upload(uuid, filename, content_type, in_file, max_retry)
+            state = dict(status='ok', attempts=attempts)
+        except ReplicaError as e:  # pragma: no cover
+            LOGGER.warning("Replica {} skipped {}: {}".format(replica.name, uuid, e))
+            state = dict(status='failed', error=str(e))
+        except Exception as e:  # pragma: no cover
+            LOGGER.error("Replica {} failed {}: {}".format(replica.name, uuid, e))
+            state = dict(status='failed', error=str(e))
+        state['modified'] = get_now().isoformat()
+        try:
+            self.save_replica_state(uuid, replica, state)
+        except Exception as e:  # pragma: no cover
+            LOGGER.error("Can't save replica state {} {}: {}".format(uuid, replica.name, e))
+        results.put((replica, state))
+
+    def upload_to_replicas(self, post_file, uuid, max_retry=10, size=0):
         filename = post_file.filename
         content_type = post_file.type
-        in_file = post_file.file
-
-        for replica in self.replica_apis:
-            auth = None
-            schema = "http"
-            if "://" in replica:
-                schema, replica = replica.split("://", 1)
-            if "@" in replica:
-                auth, replica = replica.split('@', 1)
-                auth = tuple(auth.split(':', 1))
-            post_url = "{}://{}/upload".format(schema, replica)
-            timeout = self.replica_timeout
-            replica_uuid = None
-            for n in range(max_retry):
-                try:
-                    in_file.seek(0)
-                    files = {'file': (filename, in_file, content_type, {})}
-                    res = self.session.post(post_url, auth=auth, files=files, timeout=timeout)
-                    res.raise_for_status()
-                    if res.status_code == 200:
-                        data = res.json()
-                        get_url, get_params = data['get_url'].split('?', 1)
-                        get_host, replica_uuid = get_url.rsplit('/', 1)
-                        if uuid != replica_uuid:  # pragma: no cover
-                            raise ValueError("Salve uuid mismatch, verify secret_key")
-                        LOGGER.info("Upload {} to replica {}".format(uuid, post_url))
-                        break
-                except Exception as e:  # pragma: no cover
-                    LOGGER.warning("Error {}/{} upload {} to {}: {}".format(n + 1, max_retry,
-                                    uuid, post_url, e))
-                    if n >= max_retry - 1:
-                        raise
-                    sleep(n + 1)
+        results = Queue()
+
+        for replica in self.replicas:
+            self.replica_pool.spawn(replica.name, self.upload_to_replica, replica, uuid, filename,
+                                    content_type, results, max_retry)
+
+        # wait for quorum, the rest of replicas complete in background; wait is
+        # bounded by timeouts and retry deadline plus transfer at minimal rate
+        quorum = min(self.replica_quorum, len(self.replicas))
+        deadline = None
+        if self.replica_min_rate:
+            deadline = time() + float(size) / self.replica_min_rate + max(
+                [r.retry_deadline + r.connect_timeout + r.read_timeout for r in self.replicas])
+        success = failed = 0
+        while success < quorum:
+            try:
+                replica, state = results.get(timeout=deadline and max(0, deadline - time()))
+            except Empty:
+                raise ReplicaError("Replica quorum {}/{} timeout".format(success, quorum))
+            if state['status'] == 'ok':
+                success += 1
+                continue
+            failed += 1  # pragma: no cover
+            if len(self.replicas) - failed < quorum:  # pragma: no cover
+                raise ReplicaError("Replica quorum {}/{} failed".format(failed, len(self.replicas)))
+        return success
+
+    def queue_replicas(self, post_file, uuid):
+        for replica in self.replicas:
+            self.journal.append(uuid, replica.name, filename=post_file.filename,
+                                content_type=post_file.type)
+
+    def replicate_job(self, name, job):
+        # claim is released even if job fails unexpectedly, release is idempotent
+        try:
+            replica = self.replica_names.get(job['replica'])
+            uuid = job['uuid']
+            if replica is None:  # pragma: no cover
+                LOGGER.warning("Drop replication job {}, unknown replica {}".format(name, job['replica']))
+                return self.journal.complete(name, dropped=True)
+            key, meta_name, filename, layout = self.locate(uuid)
+            if not data_exists(filename):  # pragma: no cover
+                LOGGER.warning("Drop replication job {}, file not found {}".format(name, uuid))
+                return self.journal.complete(name, dropped=True)
+            try:
+                with self.open_data(uuid, filename) as in_file, \
+                        self.metrics.timer('replica', replica=replica.name):
+                    replica.upload(uuid, job['filename'], job['content_type'], in_file, max_retry=1)
+            except ReplicaRejected as e:
+                LOGGER.warning("Drop replication job {}: {}".format(name, e))
+                self.journal.complete(name, dropped=True)
+                state = dict(status='failed', attempts=job['attempts'] + 1, error=str(e))
+            except Exception as e:  # pragma: no cover
+                LOGGER.warning("Replication job {} attempt {} failed: {}".format(name, job['attempts'] + 1, e))
+                self.journal.retry(name, job, e)
+                state = dict(status='pending', attempts=job['attempts'], error=str(e))
+            else:
+                self.journal.complete(name)
+                state = dict(status='ok', attempts=job['attempts'] + 1)
+            state['modified'] = get_now().isoformat()
+            try:
+                self.save_replica_state(uuid, replica, state)
+            except Exception as e:  # pragma: no cover
+                LOGGER.error("Can't save replica state {} {}: {}".format(uuid, replica.name, e))
+        finally:
+            self.journal.release(name)
 
+    def replication_loop(self):
+        last_report = 0
+        while True:
+            self.journal.event.wait(self.journal_poll)
+            self.journal.event.clear()
+            try:
+                # don't even claim jobs for replicas which are known to be down
+                down = set([self.journal.replica_tag(r.name) for r in self.replicas if r.is_down()])
+                # jobs of slow replica don't hold claims of others
+                inflight = dict()
+                for name in list(self.journal.inflight):
+                    tag = self.journal.job_tag(name)
+                    inflight[tag] = inflight.get(tag, 0) + 1
+                for name in self.journal.pending():
+                    tag = self.journal.job_tag(name)
+                    if tag in down or inflight.get(tag, 0) >= self.replica_pool.size:
+                        continue
+                    job = self.journal.claim(name)
+                    if job and job['replica'] in self.replica_names:
+                        inflight[tag] = inflight.get(tag, 0) + 1
+                        self.replica_pool.spawn(job['replica'], self.replicate_job, name, job)
+                    elif job:  # pragma: no cover
+                        self.replicate_job(name, job)
+                if time() - last_report > 60:
+                    stats = self.journal.stats()
+                    if stats['pending']:
+                        LOGGER.info("Replication journal {pending} pending {inflight} inflight "
+                                    "lag {lag}s".format(**stats))
+                    last_report = time()
+            except Exception as e:  # pragma: no cover
+                LOGGER.error("Replication journal error: {}".format(e))
+
+    def migration_loop(self):
+        delay = 1.0 / self.migrate_rate if self.migrate_rate > 0 else 0
+        while self.old_layout:
+            moved = skipped = 0
+            try:
+                for dirs, key in self.old_layout.walk(data=bool(self.meta_db)):
+                    if self.offload(partial(migrate, self.old_layout, self.layout, key, self.migrate_min_age,
+                                            self.dir_mode, dirs, meta=not self.meta_db)):
+                        moved += 1
+                    else:
+                        skipped += 1
+                    if delay:
+                        pause(delay)
+            except Exception as e:  # pragma: no cover
+                LOGGER.error("Layout migration error: {}".format(e))
+                skipped += 1
+            with self.stats_lock:
+                self.migration['moved'] += moved
+                self.migration['skipped'] += skipped
+                self.migration['passes'] += 1
+            LOGGER.info("Layout migration pass moved {} skipped {}".format(moved, skipped))
+            if not moved and not skipped:
+                LOGGER.info("Layout migration {} -> {} finished".format(self.old_layout, self.layout))
+                write_marker(self.save_path, self.layout)
+                self.offload(self.old_layout.prune)
+                self.old_layout = None
+                break
+            if skipped:
+                pause(self.migrate_min_age)
+
+    def count_dedup(self, **kwargs):
+        with self.stats_lock:
+            for k, v in kwargs.items():
+                self.dedup[k] += v
+
+    def compress_file(self, uuid):
+        # keep only name.gz, nginx serves it with gzip_static always and gunzip for other clients
+        key, meta_name, name, layout = self.locate(uuid)
+        try:
+            size = os.path.getsize(name)
+            gz_size = self.offload(write_sibling, name, self.compress_level, self.compress_ratio, self.file_mode)
+        except (IOError, OSError) as e:  # pragma: no cover
+            LOGGER.warning("Can't compress {}: {}".format(uuid, e))
+            return
+        if gz_size is None:
+            with self.stats_lock:
+                self.compressed['skipped'] += 1
+            return
+        with self.meta_lock:
+            meta = self.read_meta(uuid)
+            if meta.get('archived') or meta.get('quarantined'):  # pragma: no cover
+                # moved away meanwhile
+                self.offload(os.unlink, name + '.gz')
+                return
+            meta['gzip'] = dict(size=gz_size)
+            # content size is needed to stream it from name.gz
+            meta.setdefault('size', size)
+            self.save_meta(uuid, meta, overwrite=True)
+            self.offload(os.unlink, name)
+        with self.stats_lock:
+            self.compressed['files'] += 1
+            self.compressed['bytes_in'] += size
+            self.compressed['bytes_out'] += gz_size
+
+    def schedule_compress(self, uuid, size=None):
+        if self.compress and (size is None or size >= self.compress_min_size):
+            if not self.background:
+                # tool process may exit before pool runs the job
+                return self.compress_file(uuid)
+            self.compress_pool.spawn(self.compress_file, uuid)
+
+    def get_stats(self):
+        stats = dict(ingest=self.ingest.stats(), chunks=self.chunks.stats(), meta_cache=self.meta_cache.stats(),
+                     magic=self.magic.stats())
+        with self.stats_lock:
+            stats['dedup'] = dict(self.dedup)
+            if self.compress:
+                stats['compress'] = dict(self.compressed)
+        if stats['dedup']['uploads']:
+            stats['dedup']['ratio'] = round(float(stats['dedup']['duplicates']) / stats['dedup']['uploads'], 4)
+        if self.old_layout:
+            stats['layout_migration'] = dict(self.migration, source=self.old_layout.to_dict(),
+                                             target=self.layout.to_dict())
+        if self.meta_db:
+            stats['meta_db'] = self.meta_db.stats()
+        if self.archiver:
+            stats['archive'] = self.archiver.stats()
+        if self.scrub_interval:
+            stats['scrub'] = self.scrubber.stats()
+        if self.replicas:
+            stats['sync'] = self.sync.stats()
+        if self.index:
+            stats['hash_index'] = self.index.stats()
+        if self.journal:
+            stats['replication'] = self.journal.stats()
+        if self.replicas:
+            stats['replicas'] = dict([(r.name, r.stats()) for r in self.replicas])
+        return stats
+
+    @timed('register')
     def register(self, md5hash):
         if md5hash in self.forbidden_hash:
             raise StorageUploadError('forbidden_file ' + md5hash)
         now_iso = get_now().isoformat()
         uuid = self.hash_to_uuid(md5hash)
+        if self.index and self.index.get(md5hash):
+            return uuid
         meta = dict(uuid=uuid, hash=md5hash, created=now_iso)
         try:
             self.save_meta(uuid, meta)
         except ContentUploaded:
             pass
+        if self.index:
+            self.index.add(md5hash, uuid)
         return uuid
 
+    @timed('register_many')
+    def register_many(self, md5hashes):
+        for md5hash in md5hashes:
+            if md5hash in self.forbidden_hash:
+                raise StorageUploadError('forbidden_file ' + md5hash)
+        now_iso = get_now().isoformat()
+        uuids = [self.hash_to_uuid(md5hash) for md5hash in md5hashes]
+        shards = dict()
+        for uuid, md5hash in zip(uuids, md5hashes):
+            if self.index and self.index.get(md5hash):
+                continue
+            key, name, data, layout = self.locate(uuid)
+            shards.setdefault(os.path.dirname(name), dict())[uuid] = md5hash
+        if self.meta_db:
+            # single commit for whole batch
+            items = [(uuid, md5hash) for path in sorted(shards) for uuid, md5hash in shards[path].items()]
+            self.meta_db.write_many([(uuid, json.dumps(dict(uuid=uuid, hash=md5hash, created=now_iso,
+                                                            modified=now_iso)))
+                                     for uuid, md5hash in items], overwrite=False)
+            if self.index:
+                for uuid, md5hash in items:
+                    self.index.add(md5hash, uuid)
+            return uuids
+        for path in sorted(shards):
+            if not os.path.exists(path):
+                os.makedirs(path, mode=self.dir_mode)
+            for uuid, md5hash in shards[path].items():
+                meta = dict(uuid=uuid, hash=md5hash, created=now_iso)
+                try:
+                    self.save_meta(uuid, meta, create_path=False)
+                except ContentUploaded:
+                    pass
+                if self.index:
+                    self.index.add(md5hash, uuid)
+        return uuids
+
+    def scan_meta(self):
+        # yield (meta, stored) for all documents, archived documents count as stored
+        if not self.meta_db:
+            for item in scan_meta(self.save_path):
+                yield item
+            return
+        for uuid, data in self.meta_db.scan():
+            meta = json.loads(data)
+            yield meta, bool(meta.get('archived')) or data_exists(self.locate(uuid)[2])
+
+    def is_stored(self, md5hash, name, uuid=None):
+        # archived files keep stored flag in index, so complete index answers without meta read
+        if self.index:
+            found = self.index.get(md5hash)
+            if found and found[1]:
+                return True
+            if self.index.is_complete():
+                return False
+        if not data_exists(name) and not (uuid and self.is_archived(uuid)):
+            return False
+        if self.index:
+            # index enabled on existing store without rebuild
+            self.index.set(md5hash, self.hash_to_uuid(md5hash), stored=True)
+        return True
+
+    def is_archived(self, uuid):
+        try:
+            return bool(self.read_meta(uuid).get('archived'))
+        except KeyNotFound:
+            return False
+
+    @timed('upload')
     def upload(self, post_file, uuid=None):
+        with self.timer('upload', 'md5'):
+            staged = self.offload(self.ingest.stage, post_file.file)
+        try:
+            return self.upload_staged(post_file, staged, uuid)
+        finally:
+            staged.remove()
+
+    @timed('upload_chunked')
+    def upload_chunked(self, upload_id):
+        with self.timer('upload_chunked', 'md5'):
+            post_file, staged = self.chunks.complete(upload_id)
+        try:
+            result = self.upload_staged(post_file, staged)
+            # removed while staged file still holds completion lock
+            self.chunks.remove(upload_id)
+        except (HashInvalid, StorageUploadError):
+            self.chunks.remove(upload_id)
+            raise
+        finally:
+            staged.close()
+        return result
+
+    def upload_staged(self, post_file, staged, uuid=None):
         now_iso = get_now().isoformat()
         filename = get_filename(post_file.filename)
         content_type = post_file.type
-        in_file = post_file.file
-        md5hash = self.compute_md5(in_file)
+        md5hash = staged.md5hash
+        self.metrics.incr('bytes', staged.size, operation='upload')
         if md5hash in self.forbidden_hash:
             LOGGER.warning("Forbidden file by hash {}".format(md5hash))
             raise StorageUploadError('forbidden_file ' + md5hash)
 
+        registered = uuid is not None
         if uuid is None:
             uuid = self.hash_to_uuid(md5hash)
             meta = dict(uuid=uuid, hash=md5hash, created=now_iso)
@@ -197,57 +713,133 @@ class FilesStorage:
             if not compare_digest(meta['hash'], md5hash):
                 raise HashInvalid(meta['hash'] + "/" + md5hash)
 
-        key = self.uuid_to_file(uuid)
-        path, name = self.file_path(key)
-        if os.path.exists(name):
-            meta = self.read_meta(uuid)
-            if meta['filename'] != filename:
-                if 'alternatives' not in meta:
-                    meta['alternatives'] = list()
-                meta['alternatives'].append({
-                    'created': now_iso,
-                    'filename': filename
-                })
-                self.save_meta(uuid, meta, overwrite=True)
+        key, meta_name, name, layout = self.locate(uuid)
+        self.count_dedup(uploads=1)
+        if self.is_stored(md5hash, name, uuid):
+            self.count_dedup(duplicates=1, bytes_saved=staged.size)
+            # replica workers save state of the same meta
+            with self.meta_lock:
+                meta = self.read_meta(uuid)
+                changed = self.add_digests(meta, staged)
+                if meta['filename'] != filename:
+                    if 'alternatives' not in meta:
+                        meta['alternatives'] = list()
+                    meta['alternatives'].append({
+                        'created': now_iso,
+                        'filename': filename
+                    })
+                    changed = True
+                if changed:
+                    self.save_meta(uuid, meta, overwrite=True)
             return uuid, md5hash, content_type, filename
 
-        if self.check_forbidden(filename, content_type, in_file):
+        with self.timer('upload', 'forbidden'):
+            forbidden = self.check_forbidden(filename, content_type, staged.fp, staged.header, md5hash)
+        if forbidden:
             LOGGER.warning("Forbidden file {} {} {} {}".format(filename, content_type, uuid, md5hash))
             raise StorageUploadError('forbidden_file ' + md5hash)
 
-        meta['filename'] = filename
-        meta['Content-Type'] = content_type
-        meta['Content-Disposition'] = build_header(
-            filename,
-            disposition=self.disposition,
-            filename_compat=quote(filename.encode('utf-8')))
+        # validators for conditional and range requests, file mtime is set to the same time
+        uploaded = time()
+        with self.timer('upload', 'meta'), self.meta_lock:
+            if registered:
+                # read again, meta could change during forbidden check
+                meta = self.read_meta(uuid)
+            # file is stored again, registered meta may still be quarantined
+            meta.pop('quarantined', None)
+            meta['filename'] = filename
+            meta['Content-Type'] = content_type
+            meta['Content-Disposition'] = build_header(
+                filename,
+                disposition=self.disposition,
+                filename_compat=quote(filename.encode('utf-8')))
+            meta['size'] = staged.size
+            meta['ETag'] = '"{}"'.format(md5hash.split(':', 1)[-1])
+            meta['Last-Modified'] = formatdate(uploaded, usegmt=True)
+            self.add_digests(meta, staged)
+            self.save_meta(uuid, meta, overwrite=True)
 
-        self.save_meta(uuid, meta, overwrite=True)
-
-        in_file.seek(0)
-        with open(name + '~', 'wb') as out_file:
-            flock(out_file, LOCK_EX | LOCK_NB)
-            copyfileobj(in_file, out_file)
-        os.rename(name + '~', name)
-        os.chmod(name, self.file_mode)
+        with self.timer('upload', 'data'):
+            key, meta_name, name, layout = self.locate(uuid)
+            self.offload(self.publish, staged, name, uploaded)
+            if self.index:
+                self.index.set(md5hash, uuid, stored=True)
 
         try:
-            if self.replica_apis:
-                self.upload_to_replicas(post_file, uuid)
+            with self.timer('upload', 'replicas'):
+                if self.journal:
+                    self.queue_replicas(post_file, uuid)
+                elif self.replica_apis:
+                    self.upload_to_replicas(post_file, uuid, size=staged.size)
         except Exception as e:  # pragma: no cover
             LOGGER.error("Replica failed {}, remove file {} {}".format(e, uuid, md5hash))
             if self.require_replica_upload:
                 os.rename(name, name + '~')
+                if self.index:
+                    self.index.set(md5hash, uuid, stored=False)
                 raise StorageUploadError('replica_failed')
 
+        self.schedule_compress(uuid, staged.size)
         return uuid, md5hash, content_type, filename
 
+    def publish(self, staged, name, uploaded):
+        path = os.path.dirname(name)
+        if not os.path.exists(path):
+            os.makedirs(path, mode=self.dir_mode)
+        staged.publish(name, self.file_mode)
+        os.utime(name, (uploaded, uploaded))
+
+    def add_validators(self, meta, name):
+        meta.setdefault('ETag', '"{}"'.format(meta['hash'].split(':', 1)[-1]))
+        if 'gzip' not in meta:
+            # weak tag of .gz can't be used with If-Range and gunzipped responses have no ranges
+            meta['Accept-Ranges'] = 'bytes'
+        if 'size' not in meta or 'Last-Modified' not in meta:
+            # uploaded before validators were saved in meta
+            if meta.get('archived'):
+                meta.setdefault('size', (meta.get('archive') or dict()).get('size'))
+            else:
+                try:
+                    st = os.stat(name)
+                except OSError:
+                    return
+                meta.setdefault('size', st.st_size)
+                meta.setdefault('Last-Modified', formatdate(st.st_mtime, usegmt=True))
+
+    @timed('get')
     def get(self, uuid):
         meta = self.read_meta(uuid)
         if meta['uuid'] != uuid:
             raise KeyNotFound(uuid)  # pragma: no cover
         if meta['hash'] in self.forbidden_hash:
             raise KeyNotFound(uuid)  # pragma: no cover
-        key = self.uuid_to_file(uuid)
-        meta['X-Accel-Redirect'] = self.web_location(key, meta.get('archived'))
+        if meta.get('quarantined'):
+            raise KeyNotFound(uuid)
+        key, meta_name, name, layout = self.locate(uuid)
+        archive = meta.get('archive')
+        if meta.get('archived') and archive:
+            meta['X-Accel-Redirect'] = os.path.join(self.archive_web_root, archive['path']).encode()
+        else:
+            meta['X-Accel-Redirect'] = self.web_location(key, meta.get('archived'), layout)
+        if 'filename' in meta:
+            self.add_validators(meta, name)
+        if 'gzip' in meta:
+            # name.gz is served by nginx gzip_static, so both encodings share
+            # one tag and it may only be weak
+            meta['Vary'] = 'Accept-Encoding'
+            if 'ETag' in meta and not meta['ETag'].startswith('W/'):
+                meta['ETag'] = 'W/' + meta['ETag']
+        if meta.get('archived') and self.archiver and self.archiver.restore_on_access:
+            self.archiver.schedule_restore(uuid)
         return meta
+
+    def get_many(self, uuids):
+        # library api for bulk callers, not exposed by views; repeated uuids
+        # get own copies so callers may change returned meta
+        results = dict()
+        for uuid in sorted(set(uuids), key=lambda uuid: self.resolve(uuid)[1]):
+            try:
+                results[uuid] = self.get(uuid)
+            except KeyNotFound:
+                results[uuid] = None
+        return [deepcopy(results[uuid]) for uuid in uuids]
@@ -0,0 +1,292 @@
+import os
+import sys
+import gzip
+import hashlib
+import simplejson as json
+from threading import Lock, Thread
+from time import time
+from requests import HTTPError
+from openprocurement.storage.files.archive import Throttle
+from openprocurement.storage.files.compress import SizedFile
+from openprocurement.storage.files.replica import ReplicaError, WorkerPool
+from openprocurement.storage.files.utils import CounterMixin, get_now, pause
+from openprocurement.documentservice.storage import KeyNotFound
+from openprocurement.documentservice.utils import LOGGER
+
+
+def data_keys(path):
+    # compressed files are stored as key.gz in both hot and archive trees
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return set()
+    names = [s[:-3] if s.endswith('.gz') else s for s in names]
+    return set([s for s in names if '.' not in s and '~' not in s])
+
+
+def shard_dirs(path, levels, dirs=()):
+    # yield dirs tuples of all existing leaf shard directories
+    if len(dirs) == len(levels):
+        yield dirs
+        return
+    try:
+        names = sorted(os.listdir(path))
+    except OSError:
+        return
+    for name in names:
+        if len(name) == levels[len(dirs)] and os.path.isdir(os.path.join(path, name)):
+            for item in shard_dirs(os.path.join(path, name), levels, dirs + (name,)):
+                yield item
+
+
+def digest(items):
+    return hashlib.sha1('\n'.join(sorted(items))).hexdigest()
+
+
+class ThrottledFile(SizedFile):
+    def __init__(self, in_file, throttle, lock, size=None):
+        SizedFile.__init__(self, in_file, size)
+        self.throttle = throttle
+        self.lock = lock
+
+    def read(self, size=-1):
+        block = self.in_file.read(size)
+        with self.lock:
+            self.throttle(len(block))
+        return block
+
+
+class AntiEntropy(CounterMixin):
+    # hash tree over layout shard directories: root -> first level dir -> leaf dir -> keys,
+    # replicas exchange digests top down and only missing files are pushed
+    def __init__(self, storage, rate=0x2000000, workers=4, cache_ttl=60):
+        self.storage = storage
+        self.throttle = Throttle(rate)
+        self.throttle_lock = Lock()
+        self.pool = WorkerPool(workers)
+        self.cache_ttl = cache_ttl
+        self.cached = None
+        self.building = False
+        self.lock = Lock()
+        self.counters = dict(syncs=0, failures=0, shards=0, leaves=0, missing=0, pushed=0, errors=0,
+                             bytes=0)
+
+    def roots(self, dirs=()):
+        storage = self.storage
+        layout = storage.layout
+        roots = [os.path.join(layout.data_root, *dirs)]
+        if storage.archiver:
+            roots.append(os.path.join(storage.archiver.path, *(layout.data_prefix + dirs)))
+        return roots
+
+    def keys(self, dirs):
+        keys = set()
+        for path in self.roots(dirs):
+            keys |= data_keys(path)
+        return keys
+
+    def build(self):
+        if self.storage.old_layout:
+            raise ReplicaError("Layout migration in progress")
+        levels = self.storage.layout.levels
+        leaves = set()
+        for path in self.roots():
+            leaves.update(shard_dirs(path, levels))
+        shards = dict()
+        for dirs in sorted(leaves):
+            keys = self.keys(dirs)
+            if keys:
+                shards.setdefault(dirs[0], dict())['/'.join(dirs)] = digest(keys)
+        tree = dict(shards=dict([(k, digest(v.values())) for k, v in shards.items()]), leaves=shards)
+        tree['root'] = digest(tree['shards'].values())
+        return tree
+
+    def tree(self, fresh=False):
+        with self.lock:
+            cached = self.cached
+        if fresh or not cached or time() - cached[0] > self.cache_ttl:
+            cached = (time(), self.storage.offload(self.build))
+            with self.lock:
+                self.cached = cached
+        return cached[1]
+
+    def cached_tree(self):
+        # for http views, tree is never built in request thread
+        with self.lock:
+            cached = self.cached
+            start = not self.building and (not cached or time() - cached[0] > self.cache_ttl)
+            if start:
+                self.building = True
+        if start:
+            thread = Thread(target=self.refresh, name="sync-tree")
+            thread.daemon = True
+            thread.start()
+        return cached and cached[1]
+
+    def refresh(self):
+        try:
+            self.tree(fresh=True)
+        except Exception as e:
+            LOGGER.warning("Sync tree build failed: {}".format(e))
+        finally:
+            with self.lock:
+                self.building = False
+
+    def parse_shard(self, shard):
+        dirs = tuple(shard.split('/'))
+        levels = self.storage.layout.levels
+        if not 0 < len(dirs) <= len(levels) or [len(s) for s in dirs] != list(levels[:len(dirs)]) or \
+                not all([s.isalnum() for s in dirs]):
+            raise KeyNotFound(shard)
+        return dirs
+
+    def find_uuids(self, keys):
+        # map missing keys back to uuids, packed meta has to be scanned
+        storage = self.storage
+        if not storage.meta_db:
+            for key in keys:
+                try:
+                    with open(storage.layout.paths(key)[0]) as fp:
+                        meta = json.load(fp)
+                except (IOError, ValueError) as e:
+                    LOGGER.error("Sync can't read meta of {}: {}".format(key, e))
+                    continue
+                yield meta
+            return
+        keys = set(keys)
+        for meta, stored in storage.scan_meta():
+            if 'uuid' in meta and storage.uuid_to_file(meta['uuid']) in keys:
+                yield meta
+
+    def open_source(self, uuid, meta):
+        # return (file, size if file can't seek from end)
+        storage = self.storage
+        key, meta_name, name, layout = storage.locate(uuid)
+        archive = meta.get('archive')
+        if not meta.get('archived') or not archive or not storage.archiver:
+            return storage.open_data(uuid, name, meta), None
+        source = os.path.join(storage.archiver.path, archive['path'])
+        if archive.get('compression') == 'gzip':
+            return gzip.open(source + '.gz', 'rb'), archive['size']
+        return open(source, 'rb'), None
+
+    def push(self, replica, meta):
+        uuid = meta['uuid']
+        try:
+            in_file, size = self.open_source(uuid, meta)
+            try:
+                replica.upload(uuid, meta['filename'], meta['Content-Type'],
+                               ThrottledFile(in_file, self.throttle, self.throttle_lock, size), max_retry=3)
+                self.count(pushed=1, bytes=in_file.tell())
+            finally:
+                in_file.close()
+            state = dict(status='ok', attempts=1, sync=True)
+        except Exception as e:
+            LOGGER.error("Sync {} to {} failed: {}".format(uuid, replica.name, e))
+            self.count(errors=1)
+            state = dict(status='failed', error=str(e))
+        state['modified'] = get_now().isoformat()
+        try:
+            self.storage.save_replica_state(uuid, replica, state)
+        except Exception as e:  # pragma: no cover
+            LOGGER.error("Can't save replica state {} {}: {}".format(uuid, replica.name, e))
+
+    def remote_tree(self, replica, wait=30, **params):
+        # replica answers 503 while its tree is built in background
+        deadline = time() + wait
+        while True:
+            try:
+                return replica.get_json('/sync/tree', **params)
+            except HTTPError as e:
+                if e.response is not None and e.response.status_code == 403:
+                    raise ReplicaError("Replica {} denies sync, add group of replica account to its "
+                                       "files.sync_groups".format(replica.name))
+                if e.response is None or e.response.status_code != 503 or time() > deadline:
+                    raise
+            pause(1)
+
+    def sync(self, replica, limit=0):
+        remote = self.remote_tree(replica)
+        if remote['layout'] != self.storage.layout.to_dict():
+            raise ReplicaError("Replica {} layout {} differs".format(replica.name, remote['layout']))
+        local = self.tree(fresh=True)
+        if remote['root'] == local['root']:
+            return 0
+        missing = list()
+        for shard, value in sorted(local['shards'].items()):
+            if remote['shards'].get(shard) == value:
+                continue
+            self.count(shards=1)
+            remote_leaves = self.remote_tree(replica, shard=shard)['leaves']
+            for leaf, value in sorted(local['leaves'][shard].items()):
+                if remote_leaves.get(leaf) == value:
+                    continue
+                self.count(leaves=1)
+                remote_keys = set(replica.get_json('/sync/keys', shard=leaf)['keys'])
+                missing.extend(sorted(self.keys(tuple(leaf.split('/'))) - remote_keys))
+            if limit and len(missing) >= limit:
+                missing = missing[:limit]
+                break
+        self.count(missing=len(missing))
+        if not missing:
+            return 0
+        LOGGER.info("Sync {} missing files to {}".format(len(missing), replica.name))
+        self.throttle.reset()
+        for meta in self.find_uuids(missing):
+            self.pool.spawn(self.push, replica, meta)
+        self.pool.join()
+        return len(missing)
+
+    def run(self, replicas=None, limit=0):
+        pushed = 0
+        for replica in replicas or self.storage.replicas:
+            if replica.is_down():
+                continue
+            try:
+                pushed += self.sync(replica, limit)
+                self.count(syncs=1)
+            except Exception as e:
+                LOGGER.error("Sync with {} failed: {}".format(replica.name, e))
+                self.count(failures=1)
+        return pushed
+
+    def loop(self, interval):
+        while True:
+            pause(interval)
+            try:
+                self.run()
+            except Exception as e:  # pragma: no cover
+                LOGGER.error("Sync error: {}".format(e))
+
+    def start(self, interval):
+        thread = Thread(target=self.loop, args=(interval,), name="sync")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+def main(argv=sys.argv):
+    from pyramid.paster import get_appsettings, setup_logging
+    from openprocurement.storage.files.storage import FilesStorage
+    if len(argv) < 2:
+        print("usage: {} config.ini [replica_url ...]\nPush files missing on replicas "
+              "(all of files.replica_api by default)".format(argv[0]))
+        return 1
+    setup_logging(argv[1])
+    settings = get_appsettings(argv[1])
+    settings['files.background_workers'] = 'false'
+    storage = FilesStorage(settings)
+    replicas = [storage.replica_names.get(s.rstrip('/')) for s in argv[2:]]
+    if None in replicas:
+        LOGGER.error("Unknown replica, use one of {}".format(', '.join(storage.replica_names)))
+        return 1
+    storage.sync.run(replicas)
+    LOGGER.info("Sync {}".format(storage.sync.stats()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,16 +5,19 @@ import shutil
 from multiprocessing import Process
 
 
-def slave_main():
+def slave_main(config="tests.ini"):
     from openprocurement.documentservice import main
     from gevent.pywsgi import WSGIServer
     from ConfigParser import ConfigParser
-    config = os.path.dirname(__file__) + "/tests.ini"
-    defaults = dict(here=os.path.dirname(__file__))
+    here = os.path.dirname(__file__)
+    defaults = dict(here=here)
     parser = ConfigParser(defaults=defaults)
-    parser.read(config)
+    # other configs only override tests.ini
+    parser.read([here + "/tests.ini", os.path.join(here, config)])
     settings = dict(parser.items("app:main"))
     settings.pop("files.replica_api")
+    # own store, app under test removes its store on each setUp
+    settings["files.save_path"] += ".replica"
     app = main({}, **settings)
     server = WSGIServer(('127.0.0.1', 6545), app, log=None)
     server.serve_forever()
@@ -27,19 +30,22 @@ class BaseWebTest(unittest.TestCase):
     It setups the database before each test and delete it after.
     """
 
+    config = 'tests.ini'
+
     @classmethod
     def setUpClass(cls):
-        cls.slave = Process(target=slave_main)
+        cls.slave = Process(target=slave_main, args=(cls.config,))
         cls.slave.daemon = True
         cls.slave.start()
 
     @classmethod
     def tearDownClass(cls):
         cls.slave.terminate()
+        shutil.rmtree(os.path.dirname(__file__) + '/files.replica', ignore_errors=True)
 
     def setUp(self):
         self.app = webtest.TestApp(
-            "config:tests.ini", relative_to=os.path.dirname(__file__))
+            "config:" + self.config, relative_to=os.path.dirname(__file__))
         self.app.authorization = ('Basic', ('broker', 'broker'))
         save_path = self.app.relative_to + '/files'
         if os.path.exists(save_path):
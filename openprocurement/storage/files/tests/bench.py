@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+# Benchmarks, run with: python -m openprocurement.storage.files.tests.bench [--json result.json]
+# compare with previous run: --baseline result.json, limit: --only upload,wsgi --max-size 64M
+
+import os
+import cgi
+import sys
+import json
+import logging
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import timeit
+import traceback
+import zipfile
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from time import time
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+from openprocurement.documentservice.storage import StorageUploadError
+from openprocurement.documentservice.utils import LOGGER
+from openprocurement.storage.files.ingest import StagedFile, sendfile
+from openprocurement.storage.files.storage import FilesStorage
+
+
+SIZES = [1 << 10, 64 << 10, 1 << 20, 16 << 20, 256 << 20, 1 << 30]
+UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+def make_storage(**kwargs):
+    settings = {
+        'files.web_root': '/bench.files',
+        'files.save_path': tempfile.mkdtemp(prefix='bench.'),
+        'files.secret_key': 'secret',
+    }
+    settings.update(kwargs)
+    return FilesStorage(settings)
+
+
+def per_op(func, number):
+    return 1e6 * timeit.timeit(func, number=number) / number
+
+
+def parse_size(value):
+    if value[-1:].upper() in UNITS:
+        return int(value[:-1]) * UNITS[value[-1:].upper()]
+    return int(value)
+
+
+def format_size(size):
+    for unit in 'GMK':
+        if size >= UNITS[unit] and not size % UNITS[unit]:
+            return '{}{}'.format(size // UNITS[unit], unit)
+    return str(size)
+
+
+def peak_rss_mb(rusage):
+    # ru_maxrss is in kilobytes on linux
+    return rusage.ru_maxrss / 1024.0
+
+
+def run_forked(func, *args):
+    # ru_maxrss is lifetime maximum, each case runs in own child so it isn't
+    # maximum of previous cases; wait4 returns usage of this child only
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:  # pragma: no cover
+        os.close(read_fd)
+        status = 0
+        try:
+            payload = {'result': func(*args)}
+        except BaseException:
+            payload = {'error': traceback.format_exc()}
+            status = 1
+        with os.fdopen(write_fd, 'w') as fp:
+            json.dump(payload, fp)
+        os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as fp:
+        data = fp.read()
+    pid, status, rusage = os.wait4(pid, 0)
+    payload = json.loads(data) if data else {'error': 'exit status {}'.format(status)}
+    if 'error' in payload:
+        raise RuntimeError(payload['error'])
+    return dict(payload['result'], peak_rss_mb=peak_rss_mb(rusage))
+
+
+def run_case(func, *args, **kwargs):
+    storage = make_storage()
+    try:
+        return func(storage, *args, **kwargs)
+    finally:
+        shutil.rmtree(storage.save_path)
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))] if values else 0
+
+
+def summarize(latencies, elapsed, size=0):
+    latencies = sorted(latencies)
+    result = {
+        'ops': len(latencies),
+        'ops_s': len(latencies) / elapsed if elapsed else 0,
+        'p50_ms': 1e3 * percentile(latencies, 0.5),
+        'p99_ms': 1e3 * percentile(latencies, 0.99),
+    }
+    if size:
+        result['mbps'] = result['ops_s'] * size / (1 << 20)
+    return result
+
+
+def text_data(size, seed=0):
+    # hex text, random content would be sniffed as octet-stream
+    block = hashlib.sha256(str(seed)).hexdigest() * (min(size, 1 << 20) // 64 + 1)
+    return block[:min(size, 1 << 20)]
+
+
+class BenchFile(object):
+    def __init__(self, filename, fp, type='text/plain'):
+        self.filename = filename
+        self.file = fp
+        self.type = type
+
+
+def timed_call(latencies, func, *args):
+    started = time()
+    try:
+        return func(*args)
+    finally:
+        latencies.append(time() - started)
+
+
+def bench_resolve(storage, number=100000):
+    uuid = storage.hash_to_uuid('md5:' + '0' * 32)
+
+    def derive():
+        key = storage.uuid_to_file(uuid)
+        return key, storage.layout.paths(key)
+
+    def resolve():
+        return storage.resolve(uuid)
+
+    return {
+        'derive_us': per_op(derive, number),
+        'resolve_us': per_op(resolve, number),
+    }
+
+
+def bench_ingest(storage, size=64 << 20, number=5):
+    ingest = storage.ingest
+    source = tempfile.NamedTemporaryFile(dir=storage.save_path)
+    for n in range(0, size, 1 << 20):
+        source.write(os.urandom(1 << 20))
+    source.flush()
+
+    def stage(method):
+        def func():
+            fd, name = tempfile.mkstemp(dir=storage.save_path)
+            staged = StagedFile(os.fdopen(fd, 'w+b'), name)
+            method(source, staged)
+            staged.remove()
+        return func
+
+    methods = [('copy', ingest.copy)]
+    if sendfile:
+        methods.append(('sendfile', ingest.copy_kernel))
+    result = dict()
+    for name, method in methods:
+        seconds = timeit.timeit(stage(method), number=number) / number
+        result[name + '_mbps'] = size / seconds / (1 << 20)
+    source.close()
+    return result
+
+
+def make_zip(fp, entries, last='last.txt', data='content', compression=zipfile.ZIP_STORED):
+    zipobj = zipfile.ZipFile(fp, 'w', compression, allowZip64=True)
+    for n in range(entries):
+        zipobj.writestr('dir/file{}.txt'.format(n), '')
+    zipobj.writestr(last, data)
+    zipobj.close()
+    return fp
+
+
+def bench_scan(storage, entries=50000, number=3):
+    scanner = storage.scanner
+
+    def legacy(fp):
+        fp.seek(0)
+        for filename in zipfile.ZipFile(fp).namelist():
+            for ext in filename.rsplit('.', 2)[1:]:
+                if ext.upper() in storage.forbidden_ext:
+                    return True
+
+    inner = make_zip(tempfile.TemporaryFile(), 10, 'evil.bat', compression=zipfile.ZIP_DEFLATED)
+    inner.seek(0)
+    corpus = [
+        ('clean', make_zip(tempfile.TemporaryFile(), entries)),
+        ('forbidden', make_zip(tempfile.TemporaryFile(), entries, 'last.exe')),
+        ('nested', make_zip(tempfile.TemporaryFile(), entries, 'inner.zip', inner.read())),
+    ]
+    result = dict()
+    for name, fp in corpus:
+        result[name + '_ms'] = 1e3 * timeit.timeit(lambda: scanner.check_archive(fp, 'file.zip'),
+                                                   number=number) / number
+        result[name + '_legacy_ms'] = 1e3 * timeit.timeit(lambda: legacy(fp), number=number) / number
+        fp.close()
+    inner.close()
+    return result
+
+
+def bench_upload(storage, sizes=SIZES, budget=512 << 20, seed=0):
+    # unique files of each size, first bytes are replaced by counter, then get of each
+    result = dict()
+    counter = 0
+    for size in sizes:
+        number = max(3, min(200, budget // size))
+        source = tempfile.NamedTemporaryFile(dir=storage.save_path)
+        block = text_data(size, seed)
+        for n in range(0, size, len(block)):
+            source.write(block[:size - n])
+        source.flush()
+        uploads = list()
+        uuids = list()
+        started = time()
+        for n in range(number):
+            counter += 1
+            source.seek(0)
+            source.write('{:016x}'.format(counter))
+            source.flush()
+            source.seek(0)
+            uuids.append(timed_call(uploads, storage.upload, BenchFile(u'file.txt', source))[0])
+        upload = summarize(uploads, time() - started, size)
+        gets = list()
+        started = time()
+        for uuid in uuids:
+            timed_call(gets, storage.get, uuid)
+        result[format_size(size)] = {'upload': upload, 'get': summarize(gets, time() - started)}
+        source.close()
+        storage.replica_pool.join()
+        storage.compress_pool.join()
+    return result
+
+
+def bench_dedup(storage, ratios=(0, 0.5, 0.9), number=500, size=64 << 10, seed=0):
+    rnd = random.Random(seed)
+    data = text_data(size, seed)
+    result = dict()
+    for ratio in ratios:
+        before = dict(storage.get_stats()['dedup'])
+        uploaded = list()
+        latencies = list()
+        started = time()
+        for n in range(number):
+            if uploaded and rnd.random() < ratio:
+                prefix = rnd.choice(uploaded)
+            else:
+                prefix = '{}:{}:{:016x}'.format(seed, ratio, n)
+                uploaded.append(prefix)
+            timed_call(latencies, storage.upload, BenchFile(u'file.txt', StringIO(prefix + data)))
+        summary = summarize(latencies, time() - started, size)
+        stats = storage.get_stats()['dedup']
+        summary['duplicates'] = stats['duplicates'] - before['duplicates']
+        result['{:.0f}%'.format(100 * ratio)] = summary
+    return result
+
+
+def bench_forbidden(storage, number=50, entries=1000):
+    inner = make_zip(tempfile.TemporaryFile(), 10, 'evil.bat', compression=zipfile.ZIP_DEFLATED)
+    inner.seek(0)
+    nested = make_zip(StringIO(), entries, 'inner.zip', inner.read()).getvalue()
+    inner.close()
+    # rejected files are not stored, only clean ones have to be unique
+    cases = [
+        ('extension', u'file.exe', lambda n: 'MZ'),
+        ('clean_zip', u'file.zip', lambda n: make_zip(StringIO(), entries, 'last{}.txt'.format(n)).getvalue()),
+        ('nested_zip', u'file.zip', lambda n: nested),
+    ]
+    result = dict()
+    for name, filename, make in cases:
+        bodies = [make(n) for n in range(number)]
+        latencies = list()
+        rejected = 0
+        started = time()
+        for body in bodies:
+            try:
+                timed_call(latencies, storage.upload, BenchFile(filename, StringIO(body), 'application/zip'))
+            except StorageUploadError:
+                rejected += 1
+        result[name] = dict(summarize(latencies, time() - started), rejected=rejected)
+    return result
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def stub_replica(storage):
+    # accepts replica uploads like documentservice, keeps only counters
+    counters = dict(uploads=0, bytes=0)
+
+    def app(environ, start_response):
+        form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ)
+        md5hash = hashlib.md5()
+        while True:
+            block = form['file'].file.read(0x10000)
+            if not block:
+                break
+            md5hash.update(block)
+            counters['bytes'] += len(block)
+        counters['uploads'] += 1
+        uuid = storage.hash_to_uuid('md5:' + md5hash.hexdigest())
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps({'get_url': 'http://replica/get/{}?KeyID=stub'.format(uuid)})]
+
+    server = make_server('127.0.0.1', 0, app, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, name='stub-replica')
+    thread.daemon = True
+    thread.start()
+    return server, counters
+
+
+def bench_wsgi(storage, concurrency=8, number=2000, get_ratio=0.8, size=16 << 10, seed=0):
+    # upload/get mix through documentservice app, replicated to local stub
+    import webtest
+    from openprocurement.documentservice import main as app_main
+    replica, replica_counters = stub_replica(storage)
+    here = os.path.dirname(os.path.abspath(__file__))
+    settings = {
+        'auth.file': os.path.join(here, 'auth.ini'),
+        'storage': 'files',
+        'files.web_root': '/bench.files',
+        'files.save_path': os.path.join(storage.save_path, 'wsgi'),
+        'files.secret_key': 'secret',
+        'files.replica_api': 'http://127.0.0.1:{}'.format(replica.server_port),
+    }
+    app = app_main({}, **settings)
+    lock = threading.Lock()
+    get_urls = list()
+    latencies = dict(upload=list(), get=list())
+    data = text_data(size, seed)
+
+    def worker(n):
+        rnd = random.Random(seed + n)
+        client = webtest.TestApp(app)
+        client.authorization = ('Basic', ('broker', 'broker'))
+        for i in range(number // concurrency):
+            with lock:
+                url = rnd.choice(get_urls) if get_urls and rnd.random() < get_ratio else None
+            if url:
+                timed_call(latencies['get'], client.get, url)
+                continue
+            content = '{}:{}:{}\n'.format(seed, n, i) + data
+            res = timed_call(latencies['upload'], lambda: client.post(
+                '/upload', upload_files=[('file', 'file.txt', content)]))
+            with lock:
+                get_urls.append(res.json['get_url'])
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    started = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time() - started
+    replica.shutdown()
+    total = latencies['upload'] + latencies['get']
+    return {
+        'concurrency': concurrency,
+        'total': summarize(total, elapsed),
+        'upload': summarize(latencies['upload'], elapsed, size),
+        'get': summarize(latencies['get'], elapsed),
+        'replica_uploads': replica_counters['uploads'],
+    }
+
+
+BENCHMARKS = [
+    ('resolve', bench_resolve),
+    ('ingest', bench_ingest),
+    ('scan', bench_scan),
+    ('upload', bench_upload),
+    ('dedup', bench_dedup),
+    ('forbidden', bench_forbidden),
+    ('wsgi', bench_wsgi),
+]
+
+
+def flatten(result, prefix=''):
+    items = dict()
+    for k, v in result.items():
+        if isinstance(v, dict):
+            items.update(flatten(v, prefix + k + '.'))
+        elif isinstance(v, (int, long, float)):
+            items[prefix + k] = v
+    return items
+
+
+def compare(baseline, results):
+    # relative change of throughput and latency keys present in both runs
+    old = flatten(baseline.get('results', baseline))
+    changes = dict()
+    for k, v in flatten(results).items():
+        if old.get(k) and k.endswith(('ops_s', 'mbps', '_ms', '_us')):
+            changes[k] = round(float(v) / old[k] - 1, 4)
+    return changes
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description='FilesStorage benchmarks')
+    parser.add_argument('--json', help='write results as json to file, - for stdout')
+    parser.add_argument('--baseline', help='json results of previous run to compare with')
+    parser.add_argument('--only', help='comma separated benchmark names')
+    parser.add_argument('--max-size', default='1G', help='largest upload size, default 1G')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='keep storage logging')
+    args = parser.parse_args(argv[1:])
+    if not args.verbose:
+        LOGGER.setLevel(logging.ERROR)
+    names = args.only.split(',') if args.only else [name for name, func in BENCHMARKS]
+    results = dict()
+    for name, func in BENCHMARKS:
+        if name not in names:
+            continue
+        if name == 'upload':
+            # every size in own process, so peak rss is per size
+            result = dict()
+            for size in SIZES:
+                if size <= parse_size(args.max_size):
+                    case = run_forked(lambda: run_case(func, [size], seed=args.seed))
+                    result[format_size(size)] = dict(case.pop(format_size(size)), **case)
+        elif name in ('dedup', 'wsgi'):
+            result = run_forked(lambda: run_case(func, seed=args.seed))
+        else:
+            result = run_forked(lambda: run_case(func))
+        results[name] = result
+        if args.json != '-':
+            print("{:<12} {}".format(name, " ".join(
+                "{}={:.3f}".format(k, v) for k, v in sorted(flatten(result).items()))))
+    output = {
+        'created': time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'args': vars(args),
+        # largest of all cases
+        'peak_rss_mb': peak_rss_mb(resource.getrusage(resource.RUSAGE_CHILDREN)),
+        'results': results,
+    }
+    if args.baseline:
+        with open(args.baseline) as fp:
+            output['changes'] = compare(json.load(fp), results)
+        if args.json != '-':
+            for k, v in sorted(output['changes'].items()):
+                print("{:<40} {:+.1%}".format(k, v))
+    if args.json == '-':
+        print(json.dumps(output, indent=2, sort_keys=True))
+    elif args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(output, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import os
+import ctypes
+import ctypes.util
+from datetime import datetime
+from pytz import timezone
+
+
+TZ = timezone(os.environ['TZ'] if 'TZ' in os.environ else 'Europe/Kiev')
+
+
+def get_now():
+    return datetime.now(TZ)
+
+
+def pause(seconds):
+    # resolved on every call, so time.sleep patched by gevent after import is used
+    from time import sleep
+    sleep(seconds)
+
+
+def load_libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):  # pragma: no cover
+        return
+
+
+class CounterMixin(object):
+    # requires self.lock and self.counters dict
+
+    def count(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items():
+                self.counters[k] += v
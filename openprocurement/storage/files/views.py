@@ -0,0 +1,192 @@
+import re
+from base64 import b64encode
+from time import time
+from urllib import quote
+from pyramid.response import Response
+from pyramid.security import Allow, NO_PERMISSION_REQUIRED
+from pyramid.settings import asbool
+from openprocurement.documentservice.storage import HashInvalid, KeyNotFound, StorageUploadError
+from openprocurement.documentservice.utils import LOGGER
+
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+def error(request, status, name, description, location='body'):
+    request.response.status = status
+    return {'status': 'error', 'errors': [{'location': location, 'name': name, 'description': description}]}
+
+
+def upload_url(request, upload_id):
+    return request.route_url('files_chunks_upload', upload_id=upload_id)
+
+
+def signed_urls(request, uuid, md5):
+    # same as documentservice upload_view, which builds them inline,
+    # EXPIRES is read on call as files.get_url_expire may patch it
+    from openprocurement.documentservice import views
+    signer = request.registry.signer
+    keyid = request.registry.dockey
+    signature = quote(b64encode(signer.signature("{}\0{}".format(uuid, md5[4:]))))
+    url = request.route_url('get', doc_id=uuid, _query={'Signature': signature, 'KeyID': keyid})
+    expires = int(time()) + views.EXPIRES
+    signature = quote(b64encode(signer.signature("{}\0{}".format(uuid, expires))))
+    get_url = request.route_url('get', doc_id=uuid,
+                                _query={'Signature': signature, 'KeyID': keyid, 'Expires': expires})
+    return url, get_url
+
+
+def chunks_begin_view(request):
+    storage = request.registry.storage
+    filename = request.POST.get('filename')
+    if not filename:
+        return error(request, 400, 'filename', 'Required')
+    size = request.POST.get('size')
+    try:
+        upload_id = storage.chunks.begin(filename, request.POST.get('content_type', 'application/octet-stream'),
+                                         int(size) if size else None)
+    except ValueError:
+        return error(request, 400, 'size', 'Invalid')
+    except StorageUploadError as e:
+        return error(request, 400, 'size', str(e))
+    LOGGER.info("Begin chunked upload {} {}".format(upload_id, filename))
+    request.response.status = 201
+    request.response.headers['Location'] = upload_url(request, upload_id)
+    return {'data': {'id': upload_id}, 'upload_url': upload_url(request, upload_id)}
+
+
+def chunks_status_view(request):
+    try:
+        status = request.registry.storage.chunks.status(request.matchdict['upload_id'])
+    except KeyNotFound:
+        return error(request, 404, 'upload_id', 'Not Found', 'url')
+    return {'data': {'id': request.matchdict['upload_id'], 'size': status['size'],
+                     'received': status['received'], 'ranges': status['ranges'],
+                     'complete': status['complete']}}
+
+
+def chunks_write_view(request):
+    # offset comes from Content-Range: bytes start-end/total or ?offset=
+    upload_id = request.matchdict['upload_id']
+    try:
+        offset = int(request.GET.get('offset', 0))
+        length = request.content_length
+        total = None
+        if 'Content-Range' in request.headers:
+            match = CONTENT_RANGE.match(request.headers['Content-Range'])
+            if not match:
+                raise ValueError("Invalid Content-Range")
+            offset, end = int(match.group(1)), int(match.group(2))
+            if end < offset or (length is not None and length != end - offset + 1):
+                raise ValueError("Content-Range doesn't match body")
+            length = end - offset + 1
+            if match.group(3) != '*':
+                total = int(match.group(3))
+        ranges = request.registry.storage.chunks.write(upload_id, offset, request.body_file, length, total)
+    except KeyNotFound:
+        return error(request, 404, 'upload_id', 'Not Found', 'url')
+    except StorageUploadError as e:
+        if str(e) == 'chunk_overlaps':
+            # received data is already hashed, it can't be replaced
+            return error(request, 409, 'offset', str(e), 'header')
+        return error(request, 400, 'offset', str(e), 'header')
+    except ValueError as e:
+        return error(request, 400, 'offset', str(e) or 'Invalid', 'header')
+    return {'data': {'id': upload_id, 'ranges': ranges}}
+
+
+def chunks_complete_view(request):
+    upload_id = request.matchdict['upload_id']
+    storage = request.registry.storage
+    try:
+        if not storage.chunks.status(upload_id)['complete']:
+            return error(request, 409, 'file', 'Upload incomplete')
+        uuid, md5, content_type, filename = storage.upload_chunked(upload_id)
+    except KeyNotFound:
+        # also completed by concurrent request
+        return error(request, 404, 'upload_id', 'Not Found', 'url')
+    except HashInvalid as e:
+        return error(request, 403, 'file', "Invalid checksum {}".format(e))
+    except StorageUploadError as e:
+        if str(e) == 'upload_completing':
+            return error(request, 409, 'file', 'Upload is being completed')
+        return error(request, 502, 'file', 'Upload failed: {}'.format(e))
+    LOGGER.info("Complete chunked upload {} as {}".format(upload_id, uuid))
+    url, get_url = signed_urls(request, uuid, md5)
+    return {'data': {'url': url, 'hash': md5, 'format': content_type, 'title': filename}, 'get_url': get_url}
+
+
+class SyncContext(object):
+    # key inventory is only listed to files.sync_groups accounts
+    def __init__(self, acl):
+        self.__acl__ = acl
+
+
+def sync_tree_view(request):
+    storage = request.registry.storage
+    sync = storage.sync
+    if storage.old_layout:
+        return error(request, 409, 'layout', 'Layout migration in progress')
+    tree = sync.cached_tree()
+    if tree is None:
+        request.response.headers['Retry-After'] = '10'
+        return error(request, 503, 'tree', 'Building')
+    try:
+        if 'shard' not in request.GET:
+            return {'layout': request.registry.storage.layout.to_dict(), 'root': tree['root'],
+                    'shards': tree['shards']}
+        dirs = sync.parse_shard(request.GET['shard'])
+        if len(dirs) != 1:
+            raise KeyNotFound(request.GET['shard'])
+    except KeyNotFound:
+        return error(request, 404, 'shard', 'Not Found', 'url')
+    return {'shard': dirs[0], 'leaves': tree['leaves'].get(dirs[0], {})}
+
+
+def sync_keys_view(request):
+    sync = request.registry.storage.sync
+    try:
+        dirs = sync.parse_shard(request.GET.get('shard', ''))
+        if len(dirs) != len(request.registry.storage.layout.levels):
+            raise KeyNotFound(request.GET['shard'])
+    except KeyNotFound:
+        return error(request, 404, 'shard', 'Not Found', 'url')
+    return {'shard': '/'.join(dirs), 'keys': sorted(sync.keys(dirs))}
+
+
+def metrics_view(request):
+    storage = request.registry.storage
+    return Response(storage.metrics.render(storage.get_stats()), content_type='text/plain',
+                    charset='utf-8')
+
+
+def includeme(config):
+    config.add_route('files_chunks', '/chunks')
+    config.add_route('files_chunks_upload', '/chunks/{upload_id}')
+    config.add_route('files_chunks_complete', '/chunks/{upload_id}/complete')
+    settings = config.registry.settings
+    # replica_api may use uploader credentials, so both groups by default
+    sync_groups = settings.get('files.sync_groups', 'uploaders,api')
+    sync_acl = [(Allow, 'g:' + s.strip(), 'sync') for s in sync_groups.split(',') if s.strip()]
+
+    def sync_factory(request):
+        return SyncContext(sync_acl)
+
+    config.add_route('files_sync_tree', '/sync/tree', factory=sync_factory)
+    config.add_route('files_sync_keys', '/sync/keys', factory=sync_factory)
+    config.add_view(chunks_begin_view, route_name='files_chunks', renderer='json',
+                    request_method='POST', permission='upload')
+    config.add_view(chunks_status_view, route_name='files_chunks_upload', renderer='json',
+                    request_method='GET', permission='upload')
+    config.add_view(chunks_write_view, route_name='files_chunks_upload', renderer='json',
+                    request_method='PUT', permission='upload')
+    config.add_view(chunks_complete_view, route_name='files_chunks_complete', renderer='json',
+                    request_method='POST', permission='upload')
+    config.add_view(sync_tree_view, route_name='files_sync_tree', renderer='json',
+                    request_method='GET', permission='sync')
+    config.add_view(sync_keys_view, route_name='files_sync_keys', renderer='json',
+                    request_method='GET', permission='sync')
+    if asbool(settings.get('files.metrics_endpoint', False)):
+        config.add_route('files_metrics', settings.get('files.metrics_path', '/metrics'))
+        config.add_view(metrics_view, route_name='files_metrics', request_method='GET',
+                        permission=settings.get('files.metrics_permission', NO_PERMISSION_REQUIRED))
@@ -17,16 +17,29 @@ requires = [
     'setuptools',
     'simplejson'
 ]
-test_requires = requires + [
+gevent_requires = [
+    'gevent>=20.12',
+]
+test_requires = requires + gevent_requires + [
     'webtest',
     'python-coveralls',
 ]
 docs_requires = requires + [
     'sphinxcontrib-httpdomain',
 ]
+archives_requires = [
+    'libarchive-c',
+]
 entry_points = {
     'openprocurement.documentservice.plugins': [
         'files = openprocurement.storage.files:includeme'
+    ],
+    'console_scripts': [
+        'files_hash_index = openprocurement.storage.files.index:main',
+        'files_meta_import = openprocurement.storage.files.metadb:main',
+        'files_archive = openprocurement.storage.files.archive:main',
+        'files_scrub = openprocurement.storage.files.scrub:main',
+        'files_sync = openprocurement.storage.files.sync:main',
     ]
 }
 
@@ -52,6 +65,7 @@ setup(name='openprocurement.storage.files',
       zip_safe=False,
       install_requires=requires,
       tests_require=test_requires,
-      extras_require={'test': test_requires, 'docs': docs_requires},
+      extras_require={'test': test_requires, 'docs': docs_requires, 'archives': archives_requires,
+                      'gevent': gevent_requires},
       test_suite="openprocurement.storage.files.tests.main.suite",
       entry_points=entry_points)